@@ -0,0 +1,114 @@
+import asyncio
+import contextlib
+import math
+import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request would have to queue behind too many others"""
+
+    def __init__(self, work_class: "WorkClass"):
+        super().__init__(f"too many {work_class.name} requests queued")
+        self.work_class = work_class
+        self.retry_after = work_class.retry_after()
+
+
+class WorkClass:
+    """Bounds how many requests of one kind run on the executor, and how many wait.
+
+    A request past ``max_queue`` waiting ones is refused right away with
+    ``Overloaded`` instead of piling up and slowing everyone down.
+
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.max_queue = max_queue
+        self._semaphore = None
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # moving average of how long a slot is held, to tell clients when to retry
+        self.service_seconds = 1.0
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created on first use, on the loop the server runs
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    def retry_after(self) -> int:
+        backlog = (self.waiting + self.running) / max(self.limit, 1)
+        return max(1, math.ceil(backlog * self.service_seconds))
+
+    def admit(self):
+        """Refuse the request if too many are queued already"""
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            logger.warning(f"REJECTING {self.name} REQUEST, {self.waiting} QUEUED")
+            raise Overloaded(self)
+
+    async def acquire(self, admit: bool = True) -> float:
+        """Wait for a slot, returns the time it was granted to pass to ``release``"""
+        if admit:
+            self.admit()
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        granted = time.monotonic()
+        waited = granted - start
+        self.running += 1
+        self.admitted += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return granted
+
+    def release(self, granted: float):
+        self.running -= 1
+        self.service_seconds = 0.9 * self.service_seconds + 0.1 * (time.monotonic() - granted)
+        self.semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, admit: bool = True):
+        granted = await self.acquire(admit)
+        try:
+            yield
+        finally:
+            self.release(granted)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "queued": self.waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+# Builds of graphs that are not cached, they may fetch and parse whole channels
+BUILD = WorkClass("build", limit=2, max_queue=32)
+# Serialization and compression of outputs that are not cached
+SERIALIZE = WorkClass("serialize", limit=4, max_queue=32)
+# Redirects and answers straight out of the caches
+CHEAP = WorkClass("cheap", limit=16, max_queue=256)
+
+WORK_CLASSES = (BUILD, SERIALIZE, CHEAP)
+
+
+def stats() -> dict:
+    return {work_class.name: work_class.stats() for work_class in WORK_CLASSES}
@@ -1,12 +1,41 @@
 import asyncio
 import argparse
+import contextlib
 import os
+import pathlib
 import subprocess
+import typing
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from quart import Quart as Flask, redirect, abort
+from quart import Quart as Flask, Response, redirect, abort, request
 from pandas.io import json
-from graph import get_artifact_graph, ArtifactGraph, get_repo_data, REPODATA_FILE, REPODATA_FILE_CURRENT
+
+import admission
+import cache
+import fetch
+import graph
+import jlap
+import metrics
+import shared
+import shards
+import warming
+from graph import (
+    get_artifact_graph,
+    get_artifact_url,
+    warm_artifact_graph,
+    is_artifact_graph_cached,
+    is_repo_data_cached,
+    builds_inflight,
+    ArtifactGraph,
+    RawRepoData,
+    RepodataOutput,
+    COMPRESSORS,
+    etag_for,
+    REPODATA_FILE,
+    REPODATA_FILE_CURRENT,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -17,16 +46,8 @@ VERSION = "0.1.1"
 CHANNEL_MAP = {"conda-forge": "https://conda-static.anaconda.org/conda-forge"}
 INDEX_STATIC = {}
 
-CACHED_CHANNELS = [
-    ("conda-forge", "noarch"),
-    ("conda-forge", "osx-64"),
-    ("conda-forge", "linux-64"),
-    ("conda-forge", "win-64"),
-    ("defaults", 'noarch'),
-    ("defaults", 'osx-64'),
-    ("defaults", 'linux-64'),
-    ("defaults", 'win-64'),
-]
+# Seconds between two passes of the cache warmer
+WARM_INTERVAL = 30
 
 
 def fetch_artifact_graph(channel, constraints, arch, repodata_file) -> ArtifactGraph:
@@ -36,29 +57,186 @@ def fetch_artifact_graph(channel, constraints, arch, repodata_file) -> ArtifactG
     return ag
 
 
-def current_repodata_json(channel, constraints, arch):
-    ag = fetch_artifact_graph(channel, constraints, arch, REPODATA_FILE_CURRENT)
-    res = ag.repodata_json()
-    if res == 'null':
-        return None
-    return res
+def fetch_artifact_url(channel, arch, artifact):
+    channel = channel.split(",")
+    return get_artifact_url(channel=channel, arch=arch, artifact=artifact, base_url=base_url)
+
+
+def is_cached(channel, constraints, arch, artifact, repodata_file) -> bool:
+    """Tell requests answered from the caches apart from those that have to build"""
+    if artifact in ("repodata.json", "repodata.json.bz2", "current_repodata.json"):
+        return is_artifact_graph_cached(
+            channel.split(","), arch, constraints.split(","), repodata_file
+        )
+    return is_repo_data_cached(channel.split(","), arch)
+
+
+# What requests are building, the requests that need the same wait for them
+_leaders: typing.Dict[tuple, asyncio.Future] = {}
+
+
+@contextlib.asynccontextmanager
+async def build_slot(
+    channel, constraints, arch, artifact, repodata_file, cached_class=admission.CHEAP
+):
+    """A slot of ``cached_class`` for requests answered from the caches, of BUILD otherwise.
 
+    Requests needing what another one is building wait for it without holding a slot
+    or a thread, so that only the requests leading a build count against BUILD.
+
+    """
+    if artifact in ("repodata.json", "repodata.json.bz2", "current_repodata.json"):
+        key = (channel, constraints, arch, repodata_file)
+    else:
+        key = (channel, arch)
+    while True:
+        leader = _leaders.get(key)
+        if leader is None:
+            inflight = builds_inflight(
+                channel.split(","), arch, constraints.split(","), repodata_file
+            )
+            if not inflight:
+                break
+            # started by the warmer or by a request for another metachannel
+            leader = asyncio.wrap_future(inflight[0])
+        # a failed build is retried, or its error raised, by the request itself
+        with contextlib.suppress(Exception):
+            await leader
+    if is_cached(channel, constraints, arch, artifact, repodata_file):
+        async with cached_class.slot():
+            yield
+        return
+    # nothing was awaited since looking for a leader, no other request can lead it now
+    done = _leaders[key] = asyncio.get_running_loop().create_future()
+    try:
+        async with admission.BUILD.slot():
+            yield
+    finally:
+        del _leaders[key]
+        done.set_result(None)
+
+
+async def iterate_in_executor(loop, iterator, work_class: admission.WorkClass):
+    """Drive a blocking iterator from the executor, producing every item in a slot of ``work_class``"""
+    done = object()
+    step = None
+    try:
+        while True:
+            # the slot is only held while an item is produced, not while the client reads it
+            async with work_class.slot(admit=False):
+                step = loop.run_in_executor(None, metrics.bind(next), iterator, done)
+                # shielded, so that step tells when the executor is done with the iterator
+                item = await asyncio.shield(step)
+            if item is done:
+                return
+            yield item
+    finally:
+        # closing may finish the work of the iterator, keep it off the event loop
+        if step is not None and not step.done():
+            # cancelled while an item is produced, the iterator is closed right after it
+            step.add_done_callback(lambda _: loop.run_in_executor(None, iterator.close))
+        else:
+            await loop.run_in_executor(None, iterator.close)
 
-def repodata_json(channel, constraints, arch):
+
+def not_modified(etag: str) -> bool:
+    """Whether the request's If-None-Match matches ``etag``"""
+    if_none_match = request.headers.get("If-None-Match", "")
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def patch_feed(channel, constraints, arch):
+    """Bring the patch feed of a metachannel up to date, None if it has no repodata"""
     ag = fetch_artifact_graph(channel, constraints, arch, REPODATA_FILE)
-    return ag.repodata_json()
+    if not ag.constrained_names:
+        return None
+    feed = jlap.get_feed((channel, constraints, arch, REPODATA_FILE), create=True)
+    feed.update(ag)
+    return feed.render()
 
 
-def repodata_json_bz2(channel, constraints, arch):
+def shards_index(channel, constraints, arch):
     ag = fetch_artifact_graph(channel, constraints, arch, REPODATA_FILE)
-    return ag.repodata_json_bzip()
+    return shards.shards_index(ag), ag.etag
+
 
+def shard(channel, constraints, arch, digest):
+    return shards.get_shard(
+        digest, lambda: fetch_artifact_graph(channel, constraints, arch, REPODATA_FILE)
+    )
 
-async def warm_cache(loop, channel, arch, base_url):
+
+async def repodata_response(loop, ag: ArtifactGraph, encoding: str) -> Response:
+    """Answer with the body of ``ag`` or 304 when the client already holds this generation.
+
+    Bodies that are not cached yet are streamed while they are serialized and
+    compressed, rather than assembled in full before the first byte goes out.
+
+    """
+    etag = etag_for(ag.etag, encoding)
+    headers = {"ETag": etag, "Last-Modified": ag.last_modified, "Vary": "Accept-Encoding"}
+    if not_modified(etag):
+        return Response(b"", status=304, headers=headers)
+
+    async with admission.CHEAP.slot():
+        body = await loop.run_in_executor(None, metrics.bind(ag.repodata_cached), encoding)
+    if body is None:
+        future = ag.output_inflight(encoding)
+        if future is not None:
+            # another request is building this body, wait for it without holding a thread
+            value = await asyncio.wrap_future(future)
+            body = value.body if isinstance(value, RepodataOutput) else value
+    if body is None:
+        # refuse now, while we can still answer with a status
+        admission.SERIALIZE.admit()
+        # claimed here rather than on a thread, so that a request that turns out to follow
+        # the build never waits for it in one of the serialize slots the build needs
+        leader, future = ag.claim_output(encoding)
+        if leader:
+            stream = ag.iter_encoded(encoding, future)
+            body = iterate_in_executor(loop, stream, admission.SERIALIZE)
+        else:
+            value = await asyncio.wrap_future(future)
+            body = value.body if isinstance(value, RepodataOutput) else value
+
+    if encoding == "bz2":
+        content_type = "application/x-bzip2"
+    else:
+        content_type = "application/json"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+    return Response(body, headers=headers, content_type=content_type)
+
+
+def warm(key, encodings):
+    channel, constraints, arch, repodata_file = key
+    ag = warm_artifact_graph(
+        channel.split(","),
+        arch,
+        constraints.split(","),
+        repodata_file,
+        encodings=encodings,
+        base_url=base_url,
+        margin=2 * WARM_INTERVAL,
+    )
+    # record every generation clients may have fetched in the patch feed
+    feed = jlap.get_feed(key)
+    if feed is not None:
+        feed.update(ag)
+
+
+async def warm_cache(loop):
+    """Rebuild the graphs and outputs traffic asks for the most, just before they expire"""
     while True:
-        await loop.run_in_executor(None, get_repo_data, channel, arch, REPODATA_FILE_CURRENT, base_url)
-        await loop.run_in_executor(None, get_repo_data, channel, arch, REPODATA_FILE, base_url)
-        await asyncio.sleep(30)
+        await asyncio.sleep(WARM_INTERVAL)
+        for key, encodings in warming.HOT_KEYS.hottest():
+            try:
+                # background work waits its turn but is never refused
+                async with admission.BUILD.slot(admit=False):
+                    await loop.run_in_executor(None, warm, key, encodings)
+            except Exception:
+                logger.exception(f"WARMING {key} FAILED")
 
 
 @app.route("/<path:channel>/<constraints>/<arch>/<artifact>")
@@ -68,45 +246,96 @@ async def artifact(channel, constraints, arch, artifact):
           /conda-forge/pandas,ipython,scikitlearn/linux-64/artifact-5.0.0_1000.tar.bz2
 
     """
+    metrics.start_request()
     loop = asyncio.get_event_loop()
     logger.info(locals())
-    if artifact == "repodata.json":
-        return await loop.run_in_executor(
-            None, repodata_json, channel, constraints, arch
-        )
-    elif artifact == "repodata.json.bz2":
-        return await loop.run_in_executor(
-            None, repodata_json_bz2, channel, constraints, arch
-        )
-    elif artifact == 'current_repodata.json':
-        # current repodata doesn't exist for everything, so we need to be a tad more careful
-        json = await loop.run_in_executor(
-            None, current_repodata_json, channel, constraints, arch
-        )
-        if json is None:
+    if artifact in ("repodata.json", "repodata.json.bz2", "current_repodata.json"):
+        if artifact == "current_repodata.json":
+            repodata_file = REPODATA_FILE_CURRENT
+        else:
+            repodata_file = REPODATA_FILE
+        if artifact == "repodata.json.bz2":
+            encoding = "bz2"
+        else:
+            # every encoding is compressed once per generation and served from the cache
+            encoding = request.accept_encodings.best_match(
+                [e for e in ("zstd", "gzip") if e in COMPRESSORS], default="identity"
+            )
+        warming.HOT_KEYS.record((channel, constraints, arch, repodata_file), encoding)
+        async with build_slot(channel, constraints, arch, artifact, repodata_file):
+            ag = await loop.run_in_executor(
+                None,
+                metrics.bind(fetch_artifact_graph),
+                channel,
+                constraints,
+                arch,
+                repodata_file,
+            )
+        if artifact == "current_repodata.json" and not ag.constrained_names:
+            # current repodata doesn't exist for everything, so we need to be a tad more careful
             abort(404)
+        return await repodata_response(loop, ag, encoding)
+    elif artifact == "repodata.jlap":
+        warming.HOT_KEYS.record((channel, constraints, arch, REPODATA_FILE), "identity")
+        # a feed that has to catch up serializes the whole output
+        async with build_slot(
+            channel, constraints, arch, "repodata.json", REPODATA_FILE, admission.SERIALIZE
+        ):
+            body = await loop.run_in_executor(
+                None, metrics.bind(patch_feed), channel, constraints, arch
+            )
+        if body is None:
+            abort(404)
+        etag = '"%s"' % body.rstrip().rpartition(b"\n")[2].decode("ascii")
+        if not_modified(etag):
+            return Response(b"", status=304, headers={"ETag": etag})
+        return Response(body, headers={"ETag": etag}, content_type="text/plain")
+    elif artifact == shards.SHARDS_INDEX:
+        if not shards.AVAILABLE:
+            abort(404)
+        warming.HOT_KEYS.record((channel, constraints, arch, REPODATA_FILE), "identity")
+        async with build_slot(channel, constraints, arch, "repodata.json", REPODATA_FILE):
+            body, etag = await loop.run_in_executor(
+                None, metrics.bind(shards_index), channel, constraints, arch
+            )
+        if body is None:
+            abort(404)
+        etag = etag_for(etag, "shards")
+        if not_modified(etag):
+            return Response(b"", status=304, headers={"ETag": etag})
+        return Response(body, headers={"ETag": etag}, content_type="application/octet-stream")
+    elif shards.SHARD_NAME.match(artifact):
+        if not shards.AVAILABLE:
+            abort(404)
+        # content addressed, any metachannel serving these records serves the same shard
+        digest = shards.SHARD_NAME.match(artifact).group(1)
+        headers = {"ETag": f'"{digest}"', "Cache-Control": "public, max-age=31536000, immutable"}
+        if not_modified(headers["ETag"]):
+            return Response(b"", status=304, headers=headers)
+        if shards.has_shard(digest):
+            slot = admission.CHEAP.slot()
         else:
-            return json
+            slot = build_slot(channel, constraints, arch, "repodata.json", REPODATA_FILE)
+        async with slot:
+            body = await loop.run_in_executor(
+                None, metrics.bind(shard), channel, constraints, arch, digest
+            )
+        if body is None:
+            abort(404)
+        return Response(body, headers=headers, content_type="application/octet-stream")
     elif artifact.endswith('.json'):
         # if we ask for another magic json file that we don't know how to handle, just fake out
         abort(404)
     else:
-        # TODO: Do some light processing on channels.  If we are not fusing channels we can just
-        #       construct the redirect url directly without needing to do any work.
-
-        # TODO fetch these things in parallel.  current *should* be cheaper so do both, 
-        #      if success in any one of them cancel the other.  If both fail, die
-        ag = await loop.run_in_executor(
-            None, fetch_artifact_graph, channel, constraints, arch, REPODATA_FILE
-        )
-        # ag_current = await loop.run_in_executor(
-        #     None, fetch_artifact_graph, channel, constraints, arch, REPODATA_FILE_CURRENT
-        # )
-
         # Due to https://github.com/conda/conda/blob/master/conda/core/subdir_data.py#L358 we can't just use the stored
-        # urls as part of the repodata, and have to retrieve the urls instead in order to detach fused channels
-        true_url = ag.repodata_json_dict()["packages"][artifact]["url"]
-        # true_url = f'{CHANNEL_MAP[channel]}/{arch}/{artifact}'
+        # urls as part of the repodata, and have to retrieve the urls instead in order to detach fused channels.
+        # The constraints do not matter here, conda only asks for artifacts it found in our repodata.
+        async with build_slot(channel, constraints, arch, artifact, REPODATA_FILE):
+            true_url = await loop.run_in_executor(
+                None, metrics.bind(fetch_artifact_url), channel, arch, artifact
+            )
+        if true_url is None:
+            abort(404)
         return redirect(true_url)
 
 
@@ -122,6 +351,133 @@ def version():
     return json.dumps({"version": VERSION})
 
 
+@app.route("/stats")
+def stats():
+    """Returns cache statistics, including how many requests waited on another request's build
+
+    Example:
+
+        /stats
+
+    """
+    return json.dumps(
+        {
+            "repodata": RawRepoData._cache.stats(),
+            "artifact_graph": ArtifactGraph._artifact_graph_cache.stats(),
+            "output": ArtifactGraph._output_cache.stats(),
+            "budget": cache.BUDGET.stats(),
+            "admission": admission.stats(),
+            "warming": warming.HOT_KEYS.stats(),
+            "shards": shards.stats(),
+        }
+    )
+
+
+@app.route("/metrics")
+def prometheus():
+    """Returns the cache, admission and index statistics, and the phase timings of requests
+    when enabled with --metrics, for Prometheus
+
+    Example:
+
+        /metrics
+
+    """
+    caches = {
+        "repodata": RawRepoData._cache.stats(),
+        "artifact_graph": ArtifactGraph._artifact_graph_cache.stats(),
+        "output": ArtifactGraph._output_cache.stats(),
+        **{f"shard_{name}": s for name, s in shards.stats().items()},
+    }
+    families = [
+        (
+            f"metachannel_cache_{counter}_total",
+            "counter",
+            f"Cache {counter.replace('_', ' ')}",
+            [({"cache": name}, s[counter]) for name, s in caches.items()],
+        )
+        for counter in ("hits", "stale_hits", "misses", "coalesced", "refreshes", "evictions")
+    ]
+    families += [
+        (
+            "metachannel_cache_hit_ratio",
+            "gauge",
+            "Share of the lookups answered from the cache",
+            [
+                ({"cache": name}, (s["hits"] + s["stale_hits"]) / lookups)
+                for name, s in caches.items()
+                for lookups in [s["hits"] + s["stale_hits"] + s["misses"]]
+                if lookups
+            ],
+        ),
+        (
+            "metachannel_cache_inflight",
+            "gauge",
+            "Builds running in the cache",
+            [({"cache": name}, s["inflight"]) for name, s in caches.items()],
+        ),
+        (
+            "metachannel_cache_bytes",
+            "gauge",
+            "Bytes held by the cache",
+            [({"cache": name}, s["bytes"]) for name, s in caches.items()],
+        ),
+        (
+            "metachannel_index_bytes",
+            "gauge",
+            "Bytes held by the index of every channel subdir",
+            [
+                ({"channel": c, "arch": a, "file": f}, size)
+                for (c, a, f), size in RawRepoData._cache.sizes().items()
+            ],
+        ),
+    ]
+    work_classes = admission.stats()
+    for gauge in ("running", "queued"):
+        families.append(
+            (
+                f"metachannel_admission_{gauge}",
+                "gauge",
+                f"Requests {gauge} per work class",
+                [({"class": name}, s[gauge]) for name, s in work_classes.items()],
+            )
+        )
+    families.append(
+        (
+            "metachannel_admission_rejected_total",
+            "counter",
+            "Requests refused per work class",
+            [({"class": name}, s["rejected"]) for name, s in work_classes.items()],
+        )
+    )
+    return Response(
+        metrics.render(families), content_type="text/plain; version=0.0.4"
+    )
+
+
+@app.after_request
+async def server_timing(response: Response) -> Response:
+    timings = metrics.request_timings()
+    if timings is not None:
+        response.headers["Server-Timing"] = timings.header()
+    return response
+
+
+@app.errorhandler(fetch.UpstreamError)
+def upstream_error(error: fetch.UpstreamError):
+    return Response(str(error), status=502, content_type="text/plain")
+
+
+@app.errorhandler(admission.Overloaded)
+def overloaded(error: admission.Overloaded):
+    return Response(
+        str(error),
+        status=503,
+        headers={"Retry-After": str(error.retry_after)},
+        content_type="text/plain",
+    )
+
+
 @app.route("/blacklists")
 def blacklists():
     import glob
@@ -164,9 +520,95 @@ if __name__ == "__main__":
     parser.add_argument("--port", default=20124, type=int)
     parser.add_argument("--reload", action="store_true")
     parser.add_argument("--base-url", default="https://conda.anaconda.org/")
+    parser.add_argument(
+        "--max-stale",
+        default=3600,
+        type=float,
+        help="seconds an expired channel or metachannel keeps being served while it is "
+        "refreshed in the background, 0 disables serving stale data",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.expanduser("~/.cache/conda-metachannel"),
+        help="directory persisting upstream repodata across restarts, empty to disable",
+    )
+    parser.add_argument(
+        "--cache-bytes",
+        default=cache.BUDGET.max_bytes,
+        type=int,
+        help="memory budget shared by the repodata, graph and output caches",
+    )
+    parser.add_argument(
+        "--max-builds",
+        default=admission.BUILD.limit,
+        type=int,
+        help="requests building graphs or fetching channels at once",
+    )
+    parser.add_argument(
+        "--max-serializations",
+        default=admission.SERIALIZE.limit,
+        type=int,
+        help="requests serializing and compressing outputs at once",
+    )
+    parser.add_argument(
+        "--max-cheap",
+        default=admission.CHEAP.limit,
+        type=int,
+        help="redirects and cached answers served at once",
+    )
+    parser.add_argument(
+        "--max-queue",
+        default=admission.BUILD.max_queue,
+        type=int,
+        help="requests of a kind waiting for a slot past which they get a 503; "
+        "cached answers may queue 8 times as many",
+    )
+    parser.add_argument(
+        "--shared-dir",
+        default=str(shared.SHARED_DIR or ""),
+        help="directory through which the server processes of a host share one "
+        "memory-mapped copy of every channel index, and a single upstream poller; "
+        "defaults to $METACHANNEL_SHARED_DIR, empty to disable",
+    )
+    parser.add_argument(
+        "--build-processes",
+        default=0,
+        type=int,
+        help="worker processes parsing and indexing upstream repodata, 0 does it on "
+        "the server's threads",
+    )
+    parser.add_argument(
+        "--current-repodata",
+        default="upstream",
+        choices=["upstream", "derived"],
+        help="serve the current_repodata.json of the channels, or derive it from their "
+        "full repodata, which every channel then has and is fetched only once",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="time the phases of requests, reported in Server-Timing headers and /metrics",
+    )
     args = parser.parse_args()
 
     base_url = args.base_url
+    cache.BUDGET.max_bytes = args.cache_bytes
+    fetch.CACHE_DIR = pathlib.Path(args.cache_dir) if args.cache_dir else None
+    shared.SHARED_DIR = pathlib.Path(args.shared_dir) if args.shared_dir else None
+    admission.BUILD.limit = args.max_builds
+    admission.SERIALIZE.limit = args.max_serializations
+    admission.CHEAP.limit = args.max_cheap
+    admission.BUILD.max_queue = admission.SERIALIZE.max_queue = args.max_queue
+    admission.CHEAP.max_queue = 8 * args.max_queue
+    graph.CURRENT_REPODATA = args.current_repodata
+    metrics.ENABLED = args.metrics
+    RawRepoData._cache.max_stale = args.max_stale
+    ArtifactGraph._artifact_graph_cache.max_stale = args.max_stale
+    if args.build_processes > 0:
+        # spawn, forking a process that already runs threads is not safe
+        graph.BUILD_POOL = ProcessPoolExecutor(
+            args.build_processes, mp_context=multiprocessing.get_context("spawn")
+        )
 
     try:
         if in_container() and args.host == "127.0.0.1":
@@ -178,8 +620,6 @@ if __name__ == "__main__":
         pass
 
     loop = asyncio.get_event_loop()
-    # Start the background worker to run through all the channels
-    for channel, arch in CACHED_CHANNELS:
-        loop.create_task(warm_cache(loop, [channel], arch, base_url))
+    loop.create_task(warm_cache(loop))
 
     app.run(host=args.host, port=args.port, use_reloader=args.reload, loop=loop)
@@ -0,0 +1,398 @@
+import functools
+import heapq
+import itertools
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Background refreshes each cache runs at once, so that a slow one does not hold up the rest
+REFRESH_THREADS = 4
+
+
+class _Entry:
+    __slots__ = ("value", "created", "size", "cost", "hits", "priority")
+
+    def __init__(self, value, size: int, cost: float, clock: float):
+        self.value = value
+        self.created = time.monotonic()
+        self.size = size
+        self.cost = cost
+        self.hits = 1
+        self.priority = 0.0
+        self.update_priority(clock)
+
+    def update_priority(self, clock: float):
+        # Greedy-Dual-Size-Frequency: keep what is hit often and expensive to rebuild per byte
+        self.priority = clock + self.hits * self.cost / max(self.size, 1)
+
+
+class CacheBudget:
+    """A memory budget shared by several BuildCaches.
+
+    When the entries of all the caches using the budget add up to more than
+    ``max_bytes``, the entries with the lowest priority are evicted first, whichever
+    cache they belong to.  The budget's lock guards all of those caches.
+
+    Priorities are kept in a heap.  Every change of priority pushes the entry again,
+    the outdated items are skipped when they come up.
+
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.caches = []
+        self.used = 0
+        self.evictions = 0
+        # aging term of Greedy-Dual, the priority of the last eviction
+        self.clock = 0.0
+        # (priority, order, cache, key, entry), order breaks ties between equal priorities
+        self._heap = []
+        self._order = itertools.count()
+
+    def _push(self, cache: "BuildCache", key, entry: _Entry):
+        # called with the lock held
+        heapq.heappush(self._heap, (entry.priority, next(self._order), cache, key, entry))
+        if len(self._heap) > 1024 + 2 * sum(len(c.entries) for c in self.caches):
+            # mostly outdated items, hits push one each
+            self._heap = [
+                (entry.priority, next(self._order), c, key, entry)
+                for c in self.caches
+                for key, entry in c.entries.items()
+            ]
+            heapq.heapify(self._heap)
+
+    def _evict(self):
+        # called with the lock held
+        while self.used > self.max_bytes and self._heap:
+            priority, _, cache, key, entry = heapq.heappop(self._heap)
+            if cache.entries.get(key) is not entry or entry.priority != priority:
+                continue
+            logger.info(f"EVICTING {key} ({entry.size} bytes)")
+            cache._drop(key)
+            cache.evictions += 1
+            self.evictions += 1
+            self.clock = priority
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "used_bytes": self.used,
+                "entries": sum(len(cache.entries) for cache in self.caches),
+                "evictions": self.evictions,
+            }
+
+
+# Shared by the repodata, artifact graph and output caches, see --cache-bytes
+BUDGET = CacheBudget(1 << 30)
+
+
+class BuildCache:
+    """A cache that fills its misses by calling a builder, one build per key at a time.
+
+    Requests for a key that is already being built wait for that build to finish
+    instead of starting their own, so an expiring entry costs a single rebuild no
+    matter how many requests arrive while it is being rebuilt.
+
+    Entries older than ``ttl`` are stale.  As long as they are younger than
+    ``max_stale`` they keep being served while a single background refresh replaces
+    them, past that the next request blocks on a rebuild.  Setting ``max_stale`` to
+    ``ttl`` or lower disables serving stale entries.
+
+    Builders are called with the entry they replace, or None, so that they can
+    revalidate it instead of building from scratch.
+
+    Entries are accounted against a CacheBudget using ``sizeof``, and carry the time
+    their build took so that the budget can keep the costly ones.
+
+    Values that keep entries of the ``depends_on`` cache alive name their keys with
+    ``dependencies``.  Those entries are not freed while such values are cached, so
+    evicting them evicts the values depending on them too.  An entry replaced by a
+    new build stays charged with ``retained(old, new)`` bytes, its whole size by
+    default, until the last value depending on it leaves the cache.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        max_stale: float = 3600,
+        sizeof=sys.getsizeof,
+        budget: CacheBudget = BUDGET,
+        depends_on: typing.Optional["BuildCache"] = None,
+        dependencies=lambda value: (),
+        retained=None,
+    ):
+        assert depends_on is None or depends_on.budget is budget
+        self.name = name
+        self.entries = {}
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.sizeof = sizeof
+        self.budget = budget
+        self.depends_on = depends_on
+        self.dependencies = dependencies
+        self.retained = retained
+        self._lock = budget.lock
+        self._inflight = {}
+        # key -> (cache, key) of the entries of other caches depending on it
+        self._dependents = {}
+        # key -> [(bytes, dependents)] of the replaced entries of key still kept alive
+        self._retired = {}
+        # Each cache refreshes on its own threads so that a refresh waiting on another
+        # cache can never starve the refresh it is waiting on.
+        self._refresher = ThreadPoolExecutor(max_workers=REFRESH_THREADS)
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.evictions = 0
+        budget.caches.append(self)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            return entry is not None and self._servable(entry, time.monotonic())
+
+    def _servable(self, entry, now) -> bool:
+        return now - entry.created < max(self.ttl, self.max_stale)
+
+    def _remove(self, key):
+        # called with the lock held
+        entry = self.entries.pop(key)
+        self.budget.used -= entry.size
+        if self.depends_on is not None:
+            for dependency in self.dependencies(entry.value):
+                self.depends_on._release(dependency, (self, key))
+
+    def _release(self, key, dependent):
+        # called with the lock held, ``dependent`` no longer keeps ``key`` alive
+        dependents = self._dependents.get(key)
+        if dependents is not None:
+            dependents.discard(dependent)
+            if not dependents:
+                del self._dependents[key]
+        retired = []
+        for size, holders in self._retired.pop(key, ()):
+            holders.discard(dependent)
+            if holders:
+                retired.append((size, holders))
+            else:
+                self.budget.used -= size
+        if retired:
+            self._retired[key] = retired
+
+    def _drop(self, key):
+        # called with the lock held, evicts the entries depending on ``key`` with it
+        self._remove(key)
+        for cache, dependent in self._dependents.pop(key, ()):
+            if dependent in cache.entries:
+                logger.info(f"EVICTING {dependent} ALONG WITH {key}")
+                cache._drop(dependent)
+                cache.evictions += 1
+                self.budget.evictions += 1
+
+    def _hit(self, key, entry: _Entry):
+        # called with the lock held
+        self.hits += 1
+        entry.hits += 1
+        entry.update_priority(self.budget.clock)
+        self.budget._push(self, key, entry)
+
+    def get(self, key, build):
+        now = time.monotonic()
+        previous = None
+        with self._lock:
+            entry = self.entries.get(key)
+            future = self._inflight.get(key)
+            if entry is not None:
+                previous = entry.value
+                if now - entry.created < self.ttl:
+                    self._hit(key, entry)
+                    return entry.value
+                if self._servable(entry, now):
+                    self.stale_hits += 1
+                    if future is None:
+                        future = self._inflight[key] = Future()
+                        self.refreshes += 1
+                        self._refresher.submit(
+                            self._refresh, key, functools.partial(build, previous), future
+                        )
+                    return previous
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            logger.debug(f"WAITING FOR BUILD OF {key}")
+            return future.result()
+        return self._build(key, functools.partial(build, previous), future)
+
+    def peek(self, key):
+        """The servable value of ``key`` if there is one, without ever building it"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or not self._servable(entry, time.monotonic()):
+                return None
+            self._hit(key, entry)
+            return entry.value
+
+    def migrate(self, old_key, new_key, convert=lambda value: value) -> bool:
+        """Store the entry of ``old_key`` under ``new_key`` too, unless it has one already"""
+        with self._lock:
+            entry = self.entries.get(old_key)
+            if entry is None or new_key in self.entries:
+                return False
+            value = convert(entry.value)
+            self._store(new_key, value, entry.size, entry.cost)
+            return True
+
+    def age(self, key) -> typing.Optional[float]:
+        """Seconds since the entry of ``key`` was built, None if there is none"""
+        with self._lock:
+            entry = self.entries.get(key)
+            return time.monotonic() - entry.created if entry is not None else None
+
+    def refresh(self, key, build):
+        """Rebuild ``key`` ahead of its expiry, requests keep getting the current entry"""
+        with self._lock:
+            entry = self.entries.get(key)
+            previous = entry.value if entry is not None else None
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.refreshes += 1
+        if not leader:
+            return future.result()
+        return self._build(key, functools.partial(build, previous), future)
+
+    def _build(self, key, build, future):
+        start = time.monotonic()
+        try:
+            value = build()
+            size = self.sizeof(value)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        cost = time.monotonic() - start
+        with self._lock:
+            self._store(key, value, size, cost)
+            del self._inflight[key]
+        future.set_result(value)
+        return value
+
+    def _store(self, key, value, size: int, cost: float):
+        # called with the lock held
+        old = self.entries.get(key)
+        if old is not None:
+            self._remove(key)
+            dependents = self._dependents.pop(key, None)
+            if dependents:
+                # the values built over the old entry keep it alive until they go
+                kept = old.size if self.retained is None else self.retained(old.value, value)
+                self._retired.setdefault(key, []).append((kept, dependents))
+                self.budget.used += kept
+        entry = self.entries[key] = _Entry(value, size, cost, self.budget.clock)
+        self.budget.used += size
+        if self.depends_on is not None:
+            for dependency in self.dependencies(value):
+                self.depends_on._dependents.setdefault(dependency, set()).add((self, key))
+        self.budget._push(self, key, entry)
+        self.budget._evict()
+
+    def inflight(self, key) -> typing.Optional[Future]:
+        """The future of the build of ``key`` in flight, None if there is none"""
+        with self._lock:
+            return self._inflight.get(key)
+
+    def claim(self, key) -> typing.Tuple[bool, Future]:
+        """Lead the build of ``key`` outside of ``get``, or follow the one in flight.
+
+        The leader completes the returned future with ``fulfil`` or ``abandon``, the
+        future a follower gets resolves to the value once it is built.
+
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry.created < self.ttl:
+                self._hit(key, entry)
+                future = Future()
+                future.set_result(entry.value)
+                return False, future
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, future
+            future = self._inflight[key] = Future()
+            self.misses += 1
+            return True, future
+
+    def fulfil(self, key, value, cost: float, future: Future):
+        """Store the value of a build led through ``claim``"""
+        size = self.sizeof(value)
+        with self._lock:
+            self._store(key, value, size, cost)
+            del self._inflight[key]
+        future.set_result(value)
+
+    def abandon(self, key, future: Future, error: BaseException):
+        """Give up a build led through ``claim``, its followers get ``error``"""
+        with self._lock:
+            del self._inflight[key]
+        future.set_exception(error)
+
+    def put(self, key, value, cost: float):
+        """Store a value built outside of ``get``, e.g. assembled while it was streamed"""
+        size = self.sizeof(value)
+        with self._lock:
+            self._store(key, value, size, cost)
+
+    def _refresh(self, key, build, future):
+        try:
+            self._build(key, build, future)
+        except Exception:
+            # The stale entry stays in place until it passes max_stale.
+            logger.exception(f"BACKGROUND REFRESH OF {key} FAILED")
+
+    def expire(self):
+        now = time.monotonic()
+        with self._lock:
+            for key, entry in list(self.entries.items()):
+                if not self._servable(entry, now) and key in self.entries:
+                    self._drop(key)
+
+    def sizes(self) -> dict:
+        """The bytes accounted to every cached key"""
+        with self._lock:
+            return {key: entry.size for key, entry in self.entries.items()}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": sum(entry.size for entry in self.entries.values()),
+                "retired_bytes": sum(
+                    size for retired in self._retired.values() for size, _ in retired
+                ),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "refreshes": self.refreshes,
+                "evictions": self.evictions,
+                "inflight": len(self._inflight),
+            }
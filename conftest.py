@@ -0,0 +1,106 @@
+"""Fixtures shared by the unit tests"""
+
+import bz2
+import hashlib
+import itertools
+import json
+
+import pytest
+
+import fetch
+from graph import (
+    DEFAULT_BASE_URL,
+    REPODATA_FILE,
+    ArtifactGraph,
+    get_artifact_graph,
+    warm_artifact_graph,
+)
+
+_upstreams = itertools.count()
+
+
+def record(name, version, build, build_number=0, depends=(), **extra):
+    """A repodata record with just the fields the metachannel looks at"""
+    return {
+        "name": name,
+        "version": version,
+        "build": build,
+        "build_number": build_number,
+        "depends": list(depends),
+        **extra,
+    }
+
+
+class _Response:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class Upstream:
+    """Channels served from memory in place of anaconda.org.
+
+    The graphs and repodata caches are process wide and keyed on channel names, so
+    every Upstream gives its channels names of their own.
+
+    """
+
+    def __init__(self):
+        self.suffix = f"-test{next(_upstreams)}"
+        self.packages = {}
+        self.requests = []
+
+    def channel(self, name: str) -> str:
+        return name + self.suffix
+
+    def url_prefix(self, name: str, arch: str = "linux-64") -> str:
+        return f"{DEFAULT_BASE_URL}{self.channel(name)}/{arch}"
+
+    def publish(self, name: str, packages: dict, arch: str = "linux-64"):
+        """Make ``packages`` the next generation of a subdir, noarch stays empty unless given"""
+        self.packages[(self.channel(name), arch)] = dict(packages)
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(url)
+        channel, arch, filename = url.rsplit("/", 3)[-3:]
+        if (channel, arch) not in self.packages and arch != "noarch":
+            return _Response(404)
+        packages = self.packages.get((channel, arch), {})
+        body = json.dumps({"info": {"subdir": arch}, "packages": packages}).encode("utf8")
+        if filename.endswith(".bz2"):
+            body = bz2.compress(body)
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        if (headers or {}).get("If-None-Match") == etag:
+            return _Response(304, headers={"ETag": etag})
+        return _Response(200, body, {"ETag": etag})
+
+    def graph(self, channels=("main",), constraints=(), arch="linux-64") -> ArtifactGraph:
+        return get_artifact_graph(
+            [self.channel(c) for c in channels], arch, list(constraints), REPODATA_FILE
+        )
+
+    def refresh(self, channels=("main",), constraints=(), arch="linux-64") -> ArtifactGraph:
+        """Revalidate the channels and rebuild the graph, as the warming loop does"""
+        return warm_artifact_graph(
+            [self.channel(c) for c in channels],
+            arch,
+            list(constraints),
+            REPODATA_FILE,
+            margin=float("inf"),
+        )
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = Upstream()
+    monkeypatch.setattr(fetch, "SESSION", upstream)
+    return upstream
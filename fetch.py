@@ -0,0 +1,213 @@
+import functools
+import hashlib
+import os
+import pathlib
+import tempfile
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import requests
+from requests.adapters import HTTPAdapter
+from pandas.io import json
+
+logger = getLogger(__name__)
+
+# Directory holding the last payload and validators of every upstream repodata, None disables it.
+CACHE_DIR: typing.Optional[pathlib.Path] = None
+
+# Size of the chunks payloads are streamed in
+CHUNK_SIZE = 1 << 16
+
+# Seconds to wait for upstream to accept the connection, and between two reads of its answer
+TIMEOUT = (10, 60)
+
+# Upstream fetches for a request run concurrently on these threads, over one pooled session
+MAX_CONCURRENT_FETCHES = 8
+POOL = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES)
+SESSION = requests.Session()
+for _prefix in ("http://", "https://"):
+    SESSION.mount(
+        _prefix,
+        HTTPAdapter(pool_connections=16, pool_maxsize=MAX_CONCURRENT_FETCHES),
+    )
+
+
+class UpstreamError(Exception):
+    """Upstream failed to serve a repodata we already hold a generation of"""
+
+
+class Validators(typing.NamedTuple):
+    etag: typing.Optional[str] = None
+    last_modified: typing.Optional[str] = None
+    # sha256 of the payload, used to tell generations of a repodata apart
+    generation: typing.Optional[str] = None
+
+    def headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class Download:
+    """An upstream repodata payload, hashed and persisted while it is iterated over.
+
+    ``not_modified`` downloads carry no payload, the one already held by the caller
+    is still current.  The generation in ``validators`` is only filled in once the
+    payload has been read to the end, unless it is replayed from ``payload``.
+
+    """
+
+    def __init__(
+        self,
+        url: str,
+        validators: Validators,
+        response: typing.Optional[requests.Response] = None,
+        *,
+        payload: typing.Optional[typing.BinaryIO] = None,
+        ok: bool = True,
+        not_modified: bool = False,
+    ):
+        self.url = url
+        self.validators = validators
+        self.ok = ok
+        self.not_modified = not_modified
+        self._response = response
+        self._payload = payload
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        if self._payload is not None:
+            # 304 against the persisted validators, replay the persisted payload
+            with self._payload as fo:
+                yield from iter(functools.partial(fo.read, CHUNK_SIZE), b"")
+            return
+
+        sha = hashlib.sha256()
+        path = _cache_path(self.url) if CACHE_DIR is not None else None
+        fo = None
+        if path is not None:
+            try:
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                # every process and thread writes its own file, only whole ones get renamed
+                fd, tmp = tempfile.mkstemp(suffix=".payload.tmp", dir=CACHE_DIR)
+                fo = os.fdopen(fd, "wb")
+            except OSError:
+                logger.exception(f"FAILED TO PERSIST {self.url}")
+        complete = False
+        try:
+            for chunk in self._response.iter_content(CHUNK_SIZE):
+                sha.update(chunk)
+                if fo is not None:
+                    fo.write(chunk)
+                yield chunk
+            complete = True
+        except requests.RequestException as e:
+            # timed out or cut off halfway, whatever was held so far keeps being served
+            raise UpstreamError(f"FAILED TO DOWNLOAD {self.url}") from e
+        finally:
+            self._response.close()
+            if fo is not None:
+                fo.close()
+                if not complete:
+                    os.unlink(tmp)
+        self.validators = self.validators._replace(generation=sha.hexdigest())
+        if fo is not None:
+            os.replace(tmp, path.with_suffix(".payload"))
+            store_validators(self.url, self.validators)
+
+
+def _cache_path(url: str) -> pathlib.Path:
+    return CACHE_DIR / hashlib.sha256(url.encode("utf8")).hexdigest()[:32]
+
+
+def load_validators(url: str) -> typing.Optional[Validators]:
+    """Validators of the payload persisted for ``url``, if there is one"""
+    if CACHE_DIR is None:
+        return None
+    path = _cache_path(url)
+    try:
+        with path.with_suffix(".json").open() as fo:
+            meta = json.loads(fo.read())
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != url or not path.with_suffix(".payload").exists():
+        return None
+    return Validators(meta.get("etag"), meta.get("last_modified"), meta.get("generation"))
+
+
+def open_payload(url: str, generation: typing.Optional[str]) -> typing.Optional[typing.BinaryIO]:
+    """The payload persisted for ``url``, if it is the one of ``generation``.
+
+    The payload and its validators are replaced one after the other, the payload
+    is hashed so that it is never replayed under the validators of another one.
+
+    """
+    if generation is None:
+        return None
+    try:
+        fo = _cache_path(url).with_suffix(".payload").open("rb")
+    except OSError:
+        return None
+    sha = hashlib.sha256()
+    for chunk in iter(functools.partial(fo.read, CHUNK_SIZE), b""):
+        sha.update(chunk)
+    if sha.hexdigest() != generation:
+        fo.close()
+        logger.warning(f"PERSISTED PAYLOAD OF {url} DOES NOT MATCH ITS VALIDATORS")
+        return None
+    # the open file keeps this payload even if another process replaces it now
+    fo.seek(0)
+    return fo
+
+
+def store_validators(url: str, validators: Validators):
+    path = _cache_path(url).with_suffix(".json")
+    meta = dict(validators._asdict(), url=url)
+    try:
+        # write then rename so that a crash never leaves a torn file behind
+        fd, tmp = tempfile.mkstemp(suffix=".json.tmp", dir=CACHE_DIR)
+        with os.fdopen(fd, "w") as fo:
+            fo.write(json.dumps(meta))
+        os.replace(tmp, path)
+    except OSError:
+        logger.exception(f"FAILED TO PERSIST {url}")
+
+
+def fetch(url: str, validators: typing.Optional[Validators] = None) -> Download:
+    """Start fetching ``url``, sending a conditional request when validators are known.
+
+    When no validators are given the ones persisted in ``CACHE_DIR`` are used, a
+    304 answer to those is turned into the persisted payload.
+
+    """
+    from_disk = validators is None
+    if from_disk:
+        validators = load_validators(url)
+    headers = validators.headers() if validators else {}
+
+    try:
+        resp = SESSION.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+        if resp.status_code == 304:
+            logger.info(f"NOT MODIFIED {url}")
+            resp.close()
+            if not from_disk:
+                return Download(url, validators, not_modified=True)
+            payload = open_payload(url, validators.generation)
+            if payload is not None:
+                return Download(url, validators, payload=payload)
+            # the persisted copy vanished or was replaced under us, fall back to a full download
+            resp = SESSION.get(url, stream=True, timeout=TIMEOUT)
+    except requests.RequestException:
+        # answered like a failed request, so that what is held keeps being served
+        logger.exception(f"FAILED TO FETCH {url}")
+        return Download(url, Validators(), ok=False)
+
+    if not resp.ok:
+        resp.close()
+        return Download(url, Validators(), ok=False)
+
+    validators = Validators(resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+    return Download(url, validators, resp)
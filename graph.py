@@ -1,24 +1,48 @@
 import bz2
+import datetime
+import email.utils
+import hashlib
+import zlib
 from collections import deque, defaultdict
 from logging import getLogger
 import time
 import os
+import sys
 import pathlib
 import typing
-import operator
-from pprint import pformat
+import functools
+import threading
+import weakref
+from concurrent.futures import Executor, Future
 
 try:
     import ruamel.yaml as ruamel_yaml
 except ImportError:
     import ruamel_yaml
 
-import networkx
-import requests
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from pandas.io import json
 
-from sortedcontainers import SortedList
-from cachetools import LRUCache, cachedmethod, cached, TTLCache
+from cachetools import LRUCache, cached
+
+import fetch
+import ingest
+import metrics
+import shared
+from cache import BuildCache
+from index import (
+    PackageIndex,
+    LayeredIndex,
+    FEATURES,
+    changed_names,
+    index_payload,
+    latest_builds,
+)
+from versions import MatchSpec, version_order
 
 logger = getLogger(__name__)
 
@@ -27,45 +51,26 @@ DEFAULT_BASE_URL = "https://conda.anaconda.org/"
 REPODATA_FILE_CURRENT = "current_repodata.json"
 REPODATA_FILE = "repodata.json.bz2"
 
+# How current_repodata.json is served, "upstream" fetches the current repodata of the
+# channels and "derived" selects the --current records of their full repodata instead.
+CURRENT_REPODATA = "upstream"
 
-def build_repodata_graph(
-    repodata: dict, arch: str, url_prefix: str
-) -> networkx.DiGraph:
-    G = networkx.DiGraph()
-    for p, v in repodata["packages"].items():
-        name = v["name"]
-        G.add_node(name)
-        G.nodes[name].setdefault("arch", set())
-        G.nodes[name]["arch"].add(arch)
-
-        G.nodes[name].setdefault(f"packages_{arch}", {})
-        G.nodes[name][f"packages_{arch}"][p] = v
-        v["url"] = f"{url_prefix}/{p}"
-
-        for dep in v["depends"]:
-            dep_name, _, _ = dep.partition(" ")
-            G.add_edge(dep_name, name)
-
-    return G
-
+# Worker processes indexing the upstream payloads, see --build-processes.  None indexes
+# them on the calling thread.
+BUILD_POOL: typing.Optional[Executor] = None
 
-def compose_with_attrs(G: networkx.DiGraph, H: networkx.DiGraph) -> networkx.DiGraph:
-    """Composes the two graphs together in such a way as to retain / merge attributes"""   
-    I = networkx.compose(G, H)
-    for name, attrs in G.nodes(data=True):
-        for key, val in attrs.items():
-            if not key.startswith("packages_"):
-                continue
-            arch = key[9:]
-            I.nodes[name].setdefault("arch", set())
-            I.nodes[name]["arch"].add(arch)
 
-            I.nodes[name].setdefault(key, {})
-            I.nodes[name][key].update(val)
-    return I
+def recursive_parents(
+    indexes: typing.Sequence[LayeredIndex],
+    nodes,
+    known: typing.Optional[typing.Mapping[str, typing.FrozenSet[str]]] = None,
+):
+    """Names of ``nodes`` and everything they depend upon, following the edges of all ``indexes``
 
+    ``known`` maps package names to their already computed closures, which are
+    merged in as they are reached instead of being walked again.
 
-def recursive_parents(G: networkx.DiGraph, nodes):
+    """
     if isinstance(nodes, str):
         nodes = [nodes]
 
@@ -75,26 +80,131 @@ def recursive_parents(G: networkx.DiGraph, nodes):
         n = todo.popleft()
         if n in done:
             continue
+        if known and n in known:
+            done.update(known[n])
+            continue
         # conda automatically adds pip as a dep of python even when it isn't
         # this preserves this quirk
         if n == "python" and "pip" not in done:
             todo.append("pip")
+        found = False
+        for index in indexes:
+            if n in index:
+                found = True
+                todo.extend(index.dependency_names(n))
         # If we requested a package that does not exist in our graph, skip it
-        if n not in G.nodes:
+        if not found:
             # TODO: switch logging to loguru so that we can have context
             logger.warning(f"Package {n} not found in graph!")
-            done.add(n)
-            continue
-        # TODO: this seems to cause issues with root nodes like zlib
-        children = list(G.predecessors(n))
-        todo.extend(children)
         done.add(n)
     return done
 
 
+class ClosureMemo:
+    """Closures of single packages over one generation of a set of indexes.
+
+    The closure of a set of packages is the union of their closures, so constraint
+    lists that overlap share most of their work.  The indexes are passed in by the
+    callers rather than held, so that a memo never keeps an old generation alive.
+
+    """
+
+    def __init__(
+        self,
+        previous: typing.Optional["ClosureMemo"] = None,
+        changed: typing.AbstractSet[str] = frozenset(),
+    ):
+        self.closures = {}
+        if previous is not None:
+            # a closure none of whose packages changed is the same in this generation
+            self.closures = {
+                name: closure
+                for name, closure in previous.closures.items()
+                if closure.isdisjoint(changed)
+            }
+
+    def closure(self, name: str, indexes: typing.Sequence[LayeredIndex]) -> typing.FrozenSet[str]:
+        closure = self.closures.get(name)
+        if closure is None:
+            closure = frozenset(recursive_parents(indexes, [name], self.closures))
+            self.closures[name] = closure
+        return closure
+
+    def union(
+        self, names: typing.Iterable[str], indexes: typing.Sequence[LayeredIndex]
+    ) -> typing.Set[str]:
+        done = set()
+        for name in names:
+            done.update(self.closure(name, indexes))
+        return done
+
+
+_closure_memos = LRUCache(64)
+_closure_memos_lock = threading.Lock()
+
+
+def get_closure_memo(generation) -> ClosureMemo:
+    """The ClosureMemo for a generation of indexes, ``(url, generation)`` pairs of its channels.
+
+    A refreshed channel gets a new memo, which keeps the closures of the previous
+    generation that the refresh did not touch.
+
+    """
+    with _closure_memos_lock:
+        memo = _closure_memos.get(generation)
+        if memo is None:
+            previous, changed = None, frozenset()
+            predecessor = previous_generation(generation)
+            if predecessor is not None:
+                previous = _closure_memos.get(predecessor[0])
+                changed = predecessor[1]
+            memo = _closure_memos[generation] = ClosureMemo(previous, changed)
+        return memo
+
+
+# (url, generation) -> (previous generation, names changed since it)
+_generation_deltas = LRUCache(1024)
+_generation_deltas_lock = threading.Lock()
+
+# ETag -> Last-Modified of the outputs upstream gave no date for, the time they were first built
+_first_built = LRUCache(4096)
+_first_built_lock = threading.Lock()
+
+
+def previous_generation(
+    generation: typing.Sequence[typing.Tuple[str, str]]
+) -> typing.Optional[typing.Tuple[tuple, typing.FrozenSet[str]]]:
+    """The generation of a set of channels before their last refreshes, with what changed.
+
+    ``generation`` holds ``(url, generation)`` pairs; None is returned when no channel
+    has a known predecessor.
+
+    """
+    old = []
+    changed = set()
+    with _generation_deltas_lock:
+        for url, gen in generation:
+            delta = _generation_deltas.get((url, gen))
+            if delta is None:
+                old.append((url, gen))
+            else:
+                old.append((url, delta[0]))
+                changed.update(delta[1])
+    old = tuple(old)
+    if old == tuple(generation):
+        return None
+    return old, frozenset(changed)
+
+
 class RawRepoData:
     _ttl = 600
-    _cache = TTLCache(100, ttl=_ttl)
+    _cache = BuildCache(
+        "repodata",
+        ttl=_ttl,
+        sizeof=lambda raw: raw.nbytes,
+        # graphs over a replaced generation only keep its index alive when it changed
+        retained=lambda old, new: old.nbytes if old.index is not new.index else 1024,
+    )
     _last_expiry = time.monotonic()
 
     def __init__(
@@ -105,6 +215,7 @@ class RawRepoData:
         base_url: str = DEFAULT_BASE_URL,
         repodata_file: str = REPODATA_FILE,
         ttl=600,
+        previous: typing.Optional["RawRepoData"] = None,
     ):
         # setup cache
         self.ttl = ttl
@@ -125,23 +236,129 @@ class RawRepoData:
         self.arch = arch
         self.repodata_url = repodata_url
 
-        # Attempt to fetch current repodata
-        data = requests.get(repodata_url)
-        if data.ok:
-            if repodata_url.endswith(".bz2"):
-                decompressed_content = bz2.decompress(data.content)
-            else:
-                decompressed_content = data.content
-            repodata = json.loads(decompressed_content)
-            self.graph = build_repodata_graph(repodata, arch, url_prefix)
-            logger.info(f"GRAPH BUILD FOR {repodata_url}")
+        if shared.SHARED_DIR is not None:
+            with shared.lock(repodata_url):
+                self._load_shared(url_prefix, previous)
         else:
-            self.graph = None
+            self._load(url_prefix, previous)
+        self._diff(previous)
+
+    def _diff(self, previous: typing.Optional["RawRepoData"]):
+        """Record the names changed since ``previous``, when they can be known.
+
+        Dependents whose closure does not touch these names carry their results over
+        to the new generation, see ``previous_generation``.
+
+        """
+        if previous is None or previous.index is None or self.index is None:
+            return
+        if self.index is previous.index:
+            changed = frozenset()
+        else:
+            changed = changed_names(previous.index, self.index)
+            logger.info(f"{len(changed)} PACKAGES CHANGED IN {self.repodata_url}")
+            if not changed and shared.SHARED_DIR is None:
+                # only the envelope changed, keep the index everything already points to
+                self.index = previous.index
+        if self.generation != previous.generation:
+            with _generation_deltas_lock:
+                _generation_deltas[(self.repodata_url, self.generation)] = (
+                    previous.generation,
+                    changed,
+                )
+
+    def _load(self, url_prefix: str, previous: typing.Optional["RawRepoData"]):
+        # Attempt to fetch current repodata, revalidating the one we already hold
+        repodata_url = self.repodata_url
+        known = previous is not None and previous.index is not None
+        with metrics.phase("fetch"):
+            data = fetch.fetch(repodata_url, previous.validators if known else None)
+        if data.not_modified:
+            # Reuse the previous generation without parsing anything
+            self.index = previous.index
+            logger.info(f"INDEX REUSED FOR {repodata_url}")
+        elif data.ok:
+            self.index = self._build_index(data, url_prefix)
+            logger.info(f"INDEX BUILD FOR {repodata_url}")
+        elif known:
+            # the cache keeps serving the previous generation until it passes max_stale
+            raise fetch.UpstreamError(f"FAILED TO REFRESH {repodata_url}")
+        else:
+            self.index = None
+            logger.warning(f"NO BUILD FOR {repodata_url}")
+        self.validators = data.validators
+
+    def _load_shared(self, url_prefix: str, previous: typing.Optional["RawRepoData"]):
+        # Called with the lock of the url held: whichever process gets it first checks
+        # upstream, the others map what it published.
+        repodata_url = self.repodata_url
+        pub = shared.published(repodata_url)
+        if pub is not None and time.time() - pub.checked < self.ttl:
+            self.index = shared.load(pub)
+            self.validators = pub.validators
+            logger.info(f"INDEX MAPPED FOR {repodata_url}")
+            return
+
+        with metrics.phase("fetch"):
+            data = fetch.fetch(repodata_url, pub.validators if pub is not None else None)
+        if data.not_modified:
+            pub = shared.touch(pub)
+            logger.info(f"INDEX REUSED FOR {repodata_url}")
+        elif data.ok:
+            index = self._build_index(data, url_prefix)
+            # serve the shared copy rather than our own
+            pub = shared.publish(repodata_url, index, data.validators)
+            del index
+            logger.info(f"INDEX BUILD FOR {repodata_url}")
+        elif previous is not None and previous.index is not None:
+            raise fetch.UpstreamError(f"FAILED TO REFRESH {repodata_url}")
+        elif pub is not None:
+            # nothing of ours to keep serving, fall back on what was published last
+            logger.warning(f"FAILED TO REFRESH {repodata_url}, MAPPING THE PUBLISHED INDEX")
+        else:
+            self.index = None
+            self.validators = data.validators
             logger.warning(f"NO BUILD FOR {repodata_url}")
+            return
+        self.index = shared.load(pub)
+        self.validators = pub.validators
+
+    def _build_index(self, data: fetch.Download, url_prefix: str) -> PackageIndex:
+        # the body is downloaded, decompressed and parsed as it streams in
+        with metrics.phase("index") as timed:
+            index = self._index_payload(data, url_prefix)
+            timed.size = index.nbytes
+        return index
+
+    def _index_payload(self, data: fetch.Download, url_prefix: str) -> PackageIndex:
+        compressed = self.repodata_url.endswith(".bz2")
+        if BUILD_POOL is not None:
+            # Parsing holds the GIL, leave it to a worker and only load its result
+            payload = b"".join(data)
+            serialized = BUILD_POOL.submit(
+                index_payload, payload, compressed, self.arch, url_prefix
+            ).result()
+            del payload
+            return PackageIndex.from_bytes(serialized)
+        # Records stream straight from the download into the index
+        packages = ingest.iter_packages(data, compressed=compressed)
+        return PackageIndex.from_packages(packages, self.arch, url_prefix)
 
     def __hash__(self):
         return hash(self.repodata_url)
 
+    @classmethod
+    def revalidate(cls, previous: typing.Optional["RawRepoData"], **kwargs):
+        return cls(previous=previous, **kwargs)
+
+    @property
+    def generation(self) -> typing.Optional[str]:
+        return self.validators.generation
+
+    @property
+    def nbytes(self) -> int:
+        return 1024 + (self.index.nbytes if self.index is not None else 0)
+
     def __repr__(self):
         return f"RawRepoData({self.repodata_url})"
 
@@ -157,27 +374,110 @@ class RawRepoData:
 class FusedRepoData:
     """Utility class describing a set of repodatas treated as a single repository.
 
-    Packages in prior repodatas take precendence.
+    A later repodata shadows the earlier ones for every package name it has records for.
 
     """
 
     def __init__(self, raw_repodata: typing.Sequence[RawRepoData], arch):
-        logger.debug(f"FUSING: {raw_repodata}")
         self.arch = arch
-        self.component_channels = [raw_repodata[0].channel]
-        # TODO: Maybe cache this?
-        G = raw_repodata[0].graph
-        for i in range(1, len(raw_repodata)):
-            raw = raw_repodata[i]
-            self.component_channels.append(raw.channel)
-            H = raw.graph
-            G = networkx.compose(G, H)
-
-        self.graph = G
+        self.raw_repodata = raw_repodata
+        self.component_channels = [raw.channel for raw in raw_repodata]
+        layers = [raw.index for raw in raw_repodata if raw.index is not None]
+        # A view over the cached per-channel indexes, nothing is copied
+        self.index = LayeredIndex(layers) if layers else None
 
     def __repr__(self):
         return f"FusedRepoData([{''.join(self.component_channels)}], {self.arch})"
 
+    @property
+    def generation(self) -> tuple:
+        return tuple(raw.generation for raw in self.raw_repodata)
+
+    @property
+    def last_modified(self) -> typing.Optional[str]:
+        """The most recent upstream Last-Modified of the fused channels"""
+        dates = []
+        for raw in self.raw_repodata:
+            try:
+                dates.append(email.utils.parsedate_to_datetime(raw.validators.last_modified))
+            except (TypeError, ValueError):
+                continue
+        if not dates:
+            return None
+        return email.utils.format_datetime(
+            max(dates).astimezone(datetime.timezone.utc), usegmt=True
+        )
+
+    def lookup_artifact(self, artifact: str) -> typing.Optional[typing.Tuple[str, str]]:
+        """Find the ``(channel, url)`` serving an artifact filename, or None.
+
+        A later channel that provides a package name shadows every artifact of that
+        name in the earlier channels.
+
+        """
+        for raw in reversed(self.raw_repodata):
+            index = raw.index
+            rid = index.artifact_ids.get(artifact) if index is not None else None
+            if rid is None:
+                continue
+            if self.index.owner(index.name_of(rid)) is not index:
+                return None
+            return raw.channel, f"{index.url_prefix}/{artifact}"
+        return None
+
+
+def expand_channels(channel: typing.List[str], arch: str) -> typing.List[str]:
+    """Replace the ``defaults`` pseudo-channel by the channels it is made of"""
+    # Special handling for defaults because it is special
+    if "defaults" in channel:
+        if arch == "win-64":
+            new_channel = [
+                "https://repo.anaconda.com/pkgs/main",
+                "https://repo.anaconda.com/pkgs/msys",
+                "https://repo.anaconda.com/pkgs/r",
+            ]
+        else:
+            new_channel = [
+                "https://repo.anaconda.com/pkgs/main",
+                "https://repo.anaconda.com/pkgs/r",
+            ]
+        idx = channel.index("defaults")
+        channel = channel[:idx] + new_channel + channel[idx + 1 :]
+    return channel
+
+
+def get_raw_repo_data(
+    keys: typing.Iterable[typing.Tuple[str, str, str]],
+    base_url: str = DEFAULT_BASE_URL,
+) -> typing.Dict[typing.Tuple[str, str, str], RawRepoData]:
+    """Get the RawRepoData for every ``(channel, arch, repodata_file)`` key.
+
+    Keys that are not cached yet are fetched concurrently, so a cold request takes
+    about as long as its slowest channel.
+
+    """
+    RawRepoData._expire()
+
+    def get(key):
+        return RawRepoData._cache.get(key, _raw_repo_data_builder(key, base_url))
+
+    keys = list(dict.fromkeys(keys))
+    if len(keys) == 1:
+        return {keys[0]: get(keys[0])}
+    futures = [fetch.POOL.submit(metrics.bind(get), key) for key in keys]
+    return {key: future.result() for key, future in zip(keys, futures)}
+
+
+def _raw_repo_data_builder(key: typing.Tuple[str, str, str], base_url: str):
+    c, arch, repodata_file = key
+    return functools.partial(
+        RawRepoData.revalidate,
+        channel=c,
+        arch=arch,
+        base_url=base_url,
+        repodata_file=repodata_file,
+    )
+
 
 def get_repo_data(
     channel: typing.List[str],
@@ -185,18 +485,16 @@ def get_repo_data(
     repodata_file: str,
     base_url: str = DEFAULT_BASE_URL,
 ) -> FusedRepoData:
-    repodatas = []
-    RawRepoData._expire()
-    for c in channel:
-        key = (c, arch, repodata_file)
-        # TODO: This should happen in parallel
-        if key not in RawRepoData._cache:
-            logger.info("refreshing cache for {c}/{arch}")
-            RawRepoData._cache[key] = RawRepoData(
-                channel=c, arch=arch, base_url=base_url, repodata_file=repodata_file
-            )
-        repodatas.append(RawRepoData._cache[key])
-    return FusedRepoData(repodatas, arch)
+    keys = [(c, arch, repodata_file) for c in channel]
+    raw = get_raw_repo_data(keys, base_url=base_url)
+    return FusedRepoData([raw[key] for key in keys], arch)
+
+
+def source_file(repodata_file: str) -> str:
+    """The upstream file the records of ``repodata_file`` come from"""
+    if repodata_file == REPODATA_FILE_CURRENT and CURRENT_REPODATA == "derived":
+        return REPODATA_FILE
+    return repodata_file
 
 
 def parse_constraints(constraints):
@@ -214,6 +512,44 @@ def parse_constraints(constraints):
     return package_constraints, functional_constraints
 
 
+FEATURE_MAP = {
+    "blas_openblas": "blas * openblas",
+    "blas_mkl": "blas * mkl",
+    "blas_nomkl": "blas * nomkl",
+    "vc9": "vs2008_runtime",
+    "vc10": "vs2010_runtime",
+    "vc14": "vs2015_runtime",
+}
+
+
+def untrack_features(record: dict) -> dict:
+    """Replace the tracked features of a record by the appropriate dependencies.
+
+    Returns a new record, the one given is left untouched.
+
+    """
+    record = dict(record)
+    depends = list(record.get("depends", ()))
+    kept_features = []
+    for feature in record.get("features", "").split(" "):
+        if feature in FEATURE_MAP:
+            if FEATURE_MAP[feature] not in depends:
+                depends.append(FEATURE_MAP[feature])
+        else:
+            kept_features.append(feature)
+    record["depends"] = depends
+    kept_features = " ".join(kept_features)
+    if kept_features:
+        record["features"] = kept_features
+    else:
+        record.pop("features", None)
+
+    # For feature packages get rid of mapped things
+    if record.get("track_features") in FEATURE_MAP:
+        del record["track_features"]
+    return record
+
+
 @cached(cache={})
 def get_blacklist(blacklist_name, channel, arch):
     path = pathlib.Path("blacklists") / channel / (blacklist_name + ".yml")
@@ -225,9 +561,34 @@ def get_blacklist(blacklist_name, channel, arch):
         return set()
 
 
+@cached(cache={})
+def get_effective_blacklist(
+    blacklist_names: typing.Tuple[str, ...], channels: typing.Tuple[str, ...], arch
+) -> typing.FrozenSet[str]:
+    """The artifacts blacklisted by any of the blacklists of any of the channels"""
+    return frozenset(
+        fn
+        for blacklist_name in blacklist_names
+        for channel in channels
+        for fn in get_blacklist(blacklist_name, channel, arch)
+    )
+
+
 class ArtifactGraph:
     _ttl = 600
-    _artifact_graph_cache = TTLCache(100, ttl=_ttl)
+    # Graphs keep the indexes of their repodata alive, they are evicted along with them
+    _artifact_graph_cache = BuildCache(
+        "artifact_graph",
+        ttl=_ttl,
+        sizeof=lambda ag: ag.nbytes,
+        depends_on=RawRepoData._cache,
+        dependencies=lambda ag: ag.raw_keys,
+    )
+    # Serialized outputs, keyed on what they are made of rather than on the url asked for.
+    # Those keys include the channel generations so the entries never go stale.
+    _output_cache = BuildCache(
+        "output", ttl=float("inf"), sizeof=lambda value: _output_size(value)
+    )
     _last_expiry = time.monotonic()
 
     def __init__(
@@ -238,42 +599,50 @@ class ArtifactGraph:
         self.arch = arch
         self.constraints = constraints
 
-        self.raw = get_repo_data(
-            channel=channel, arch=arch, base_url=base_url, repodata_file=repodata_file
-        )
-        if self.raw.graph is not None:
-
-            # TODO: Since solving the artifact graph happens twice for a given conda operation, once for arch and once for
-            #       noarch we need to treat the noarch channel here as an arch channel.
-            #       The choice of noarch standin as linux-64 is mostly convenience.
-            #       In the future it may be wiser to just store the whole are collectively.
-
-            if arch != "noarch":
-                self.noarch = get_repo_data(
-                    channel=channel,
-                    arch="noarch",
-                    base_url=base_url,
-                    repodata_file=repodata_file,
-                )
-            else:
-                self.noarch = get_repo_data(
-                    channel=channel,
-                    arch="linux-64",
-                    base_url=base_url,
-                    repodata_file=repodata_file,
-                )
+        # TODO: Since solving the artifact graph happens twice for a given conda operation, once for arch and once for
+        #       noarch we need to treat the noarch channel here as an arch channel.
+        #       The choice of noarch standin as linux-64 is mostly convenience.
+        #       In the future it may be wiser to just store the whole are collectively.
+        noarch = "noarch" if arch != "noarch" else "linux-64"
+
+        source = source_file(repodata_file)
+        if source != repodata_file:
+            # the current records are a view over the full repodata
+            constraints = [*constraints, "--current"]
+
+        # Fetch both subdirs of every channel at once
+        self.raw_keys = [(c, a, source) for a in (arch, noarch) for c in channel]
+        raw = get_raw_repo_data(self.raw_keys, base_url=base_url)
+        self.raw = FusedRepoData([raw[(c, arch, source)] for c in channel], arch)
+        if self.raw.index is not None:
+            self.noarch = FusedRepoData([raw[(c, noarch, source)] for c in channel], noarch)
 
             self.package_constraints, self.functional_constraints = parse_constraints(
                 constraints
             )
-
-            self.constrain_graph(
-                self.raw.graph, self.noarch.graph, self.package_constraints
+            self.current = "--current" in self.functional_constraints
+            self.pins, self.latest_n = self.parse_record_constraints(
+                self.functional_constraints
             )
-        else:
-            self.constrained_graph = None
+            self._satisfiable = {}
+            self._pinned = {}
+            self.max_build_no = "--max-build-no" in self.functional_constraints
+            self.blacklist = get_effective_blacklist(
+                tuple(sorted(self.functional_constraints.get("--blacklist", ()))),
+                tuple(self.raw.component_channels),
+                arch,
+            )
+            self.untrack = "--untrack-features" in self.functional_constraints
 
-        self._repodata_cache = TTLCache(100, ttl=self._ttl)
+            with metrics.phase("closure"):
+                self.constrain_graph(
+                    self.raw.index, self.noarch.index, self.package_constraints
+                )
+            self.output_key = self.canonical_key()
+            self._inherit_outputs()
+        else:
+            self.constrained_names = None
+            self.output_key = None
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.channel!r}, {self.arch!r}, {self.constraints!r})"
@@ -287,139 +656,430 @@ class ArtifactGraph:
             cls._last_expiry = current
         return cls._artifact_graph_cache
 
-    def constrain_graph(self, graph, noarch_graph, constraints):
-        # Since noarch is solved along with our normal channel we need to combine the two for our effective
-        # graph.
-        combined_graph = compose_with_attrs(graph, noarch_graph)
-        if constraints:
-            nodes = recursive_parents(combined_graph, constraints)
-            subset = combined_graph.subgraph(nodes)
-            self.constrained_graph = subset
+    def constrain_graph(self, index, noarch_index, constraints):
+        # Since noarch is solved along with our normal channel we need to follow the dependencies
+        # of both.
+        indexes = [i for i in (index, noarch_index) if i is not None]
+        # Closures are sets, sort them so that every process writes the same body, see etag
+        if constraints and (self.pins or self.latest_n or self.current):
+            nodes = self.pruned_closure(indexes, constraints)
+            self.constrained_names = sorted(n for n in nodes if any(n in i for i in indexes))
+        elif constraints:
+            generation = tuple(
+                (raw.repodata_url, raw.generation)
+                for raw in (*self.raw.raw_repodata, *self.noarch.raw_repodata)
+            )
+            memo = get_closure_memo(generation)
+            nodes = memo.union(constraints, indexes)
+            self.constrained_names = sorted(n for n in nodes if any(n in i for i in indexes))
         else:
-            self.constrained_graph = combined_graph
+            self.constrained_names = index.names
+
+    @staticmethod
+    def parse_record_constraints(
+        functional_constraints,
+    ) -> typing.Tuple[typing.Dict[str, MatchSpec], typing.Optional[int]]:
+        """The ``--pin=<spec>`` and ``--latest-n=<n>`` constraints, which select records"""
+        pins = {}
+        for spec in functional_constraints.get("--pin", ()):
+            try:
+                pin = MatchSpec.parse(spec)
+            except ValueError:
+                logger.warning(f"Ignoring invalid pin {spec!r}")
+                continue
+            pins[pin.name] = pin
+        latest_n = None
+        for n in functional_constraints.get("--latest-n", ()):
+            if n.isdigit() and int(n) > 0:
+                latest_n = min(int(n), latest_n or int(n))
+            else:
+                logger.warning(f"Ignoring invalid --latest-n={n}")
+        return pins, latest_n
+
+    def pruned_closure(self, indexes, nodes) -> typing.Set[str]:
+        """Like recursive_parents, only following the dependencies of the records we keep"""
+        done = set()
+        todo = deque(nodes)
+        while todo:
+            n = todo.popleft()
+            if n in done:
+                continue
+            # conda automatically adds pip as a dep of python even when it isn't
+            # this preserves this quirk
+            if n == "python" and "pip" not in done:
+                todo.append("pip")
+            found = False
+            for index in indexes:
+                if n not in index:
+                    continue
+                found = True
+                layer, rids = index.records_of(n)
+                for rid in self.keep_records(layer, n, rids):
+                    todo.extend(layer.names[d] for d in layer.record_dependency_ids(rid))
+            if not found:
+                logger.warning(f"Package {n} not found in graph!")
+            done.add(n)
+        return done
+
+    def keep_records(self, layer: PackageIndex, name: str, rids) -> typing.Sequence[int]:
+        """The records of ``name`` that satisfy the pins, of its latest versions"""
+        if not rids or not (self.pins or self.latest_n or self.current):
+            return rids
+        if self.current:
+            current = layer.current
+            rids = [r for r in rids if current[r]]
+        pin = self.pins.get(name)
+        if pin is not None:
+            rids = [r for r in rids if pin.match(layer.versions[r], layer.builds[r])]
+        if self.pins:
+            rids = [r for r in rids if self.satisfiable(layer, r)]
+        if self.latest_n:
+            versions = sorted(
+                {layer.versions[r] for r in rids}, key=version_order, reverse=True
+            )
+            latest = set(versions[: self.latest_n])
+            rids = [r for r in rids if layer.versions[r] in latest]
+        return rids
+
+    def satisfiable(self, layer: PackageIndex, rid: int) -> bool:
+        """Whether the dependencies of a record on pinned packages can be met"""
+        if not any(layer.names[d] in self.pins for d in layer.record_dependency_ids(rid)):
+            return True
+        for dep in layer.record(rid).get("depends", ()):
+            ok = self._satisfiable.get(dep)
+            if ok is None:
+                try:
+                    spec = MatchSpec.parse(dep)
+                except ValueError:
+                    # leave what we do not understand to the solver
+                    spec = None
+                ok = spec is None or spec.name not in self.pins or any(
+                    spec.match(version, build) for version, build in self.pinned(spec.name)
+                )
+                self._satisfiable[dep] = ok
+            if not ok:
+                return False
+        return True
+
+    def pinned(self, name: str) -> typing.List[typing.Tuple[str, str]]:
+        """Versions and builds of the records of a pinned package that match its pin"""
+        pinned = self._pinned.get(name)
+        if pinned is None:
+            pin = self.pins[name]
+            pinned = self._pinned[name] = []
+            for index in (self.raw.index, self.noarch.index):
+                if index is None:
+                    continue
+                layer, rids = index.records_of(name)
+                if self.current and layer is not None:
+                    current = layer.current
+                    rids = [r for r in rids if current[r]]
+                pinned.extend(
+                    (layer.versions[r], layer.builds[r])
+                    for r in rids
+                    if pin.match(layer.versions[r], layer.builds[r])
+                )
+        return pinned
+
+    @property
+    def nbytes(self) -> int:
+        # the indexes are accounted for by the repodata cache, which evicts us along with
+        # them, only our closure is ours
+        if self.constrained_names is None or not self.package_constraints:
+            return 1024
+        return 1024 + sum(8 + sys.getsizeof(n) for n in self.constrained_names)
+
+    def canonical_key(self) -> tuple:
+        """Identifies the output of this graph, whichever constraints produced it"""
+        raws = tuple((raw.repodata_url, raw.generation) for raw in self.raw.raw_repodata)
+        if self.pins:
+            # pins are matched against the noarch records too
+            raws += tuple(
+                (raw.repodata_url, raw.generation) for raw in self.noarch.raw_repodata
+            )
+        if self.package_constraints:
+            names = frozenset(self.constrained_names)
+        else:
+            names = None
+        functional = tuple(
+            sorted((k, tuple(sorted(v))) for k, v in self.functional_constraints.items())
+        )
+        return raws, self.arch, names, functional
+
+    def _inherit_outputs(self):
+        """Carry the outputs of the previous generation over if none of our packages changed"""
+        if self.current:
+            # which records are current depends on every package of the index, including
+            # those outside of our closure
+            return
+        raws, arch, names, functional = self.output_key
+        predecessor = previous_generation(raws)
+        if predecessor is None:
+            return
+        old_raws, changed = predecessor
+        if changed and (names is None or not names.isdisjoint(changed)):
+            return
+        old_key = (old_raws, arch, names, functional)
+        migrated = [
+            encoding
+            for encoding in ("identity", *COMPRESSORS)
+            if self._output_cache.migrate(
+                (old_key, encoding),
+                (self.output_key, encoding),
+                lambda value: value._replace(etag=self.etag, last_modified=self.last_modified)
+                if isinstance(value, RepodataOutput)
+                else value,
+            )
+        ]
+        if migrated:
+            logger.info(f"OUTPUTS CARRIED OVER FOR {self} IN {migrated}")
+
+    def iter_records(self) -> typing.Iterator[typing.Tuple[str, bytes]]:
+        """Yield the filename and serialized record of every artifact we serve"""
+        for n in self.constrained_names:
+            yield from self.records_of(n)
+
+    def records_of(self, name: str) -> typing.Iterator[typing.Tuple[str, bytes]]:
+        """Yield the filename and serialized record of the artifacts we serve for ``name``"""
+        index, rids = self.raw.index.records_of(name)
+        if index is None:
+            return
+        rids = self.keep_records(index, name, rids)
+        latest = None
+        if self.max_build_no:
+            if self.pins:
+                # the top builds among the records the pins left
+                rids = latest_builds(index, rids)
+            else:
+                # which versions we keep has no bearing on the top build of each
+                latest = index.latest_builds
+        blacklist = self.blacklist
+        filenames = index.filenames
+        for rid in rids:
+            fn = filenames[rid]
+            if (latest is not None and not latest[rid]) or fn in blacklist:
+                continue
+            if self.untrack and index.flags[rid] & FEATURES:
+                yield fn, index.rewritten(rid, untrack_features)
+            else:
+                yield fn, index.fragment(rid)
 
     def repodata_json_dict(self):
-        if self.constrained_graph:
-            all_packages = {}
-            for n in self.constrained_graph:
-                logger.debug(n)
-                packages = self.constrained_graph.nodes[n].get(f"packages_{self.arch}", {})
-
-                if "--max-build-no" in self.functional_constraints:
-                    # packages with build strings should always be included
-                    packages = self.constrain_by_build_number(packages)
-
-                if "--untrack-features" in self.functional_constraints:
-                    packages = self.untrack_features(packages)
-
-                if "--blacklist" in self.functional_constraints:
-                    for blacklist_name in self.functional_constraints["--blacklist"]:
-                        packages = self.constrain_by_blacklist(packages, blacklist_name)
-
-                if n == "blas":
-                    logger.debug(pformat(packages))
-                all_packages.update(packages)
-
-            return {"packages": all_packages}
+        if self.constrained_names:
+            return {
+                "packages": {
+                    filename: json.loads(fragment)
+                    for filename, fragment in self.iter_records()
+                }
+            }
         else:
             return None
 
-    def constrain_by_build_number(self, packages):
-        """For a given packages dictionary ensure that only the top build number for a given build_string is kept
-
-        Packages without a build number (such as the blas mutex package are unaffected)
-
-            k: artifact_name, v: package information dictionary
+    @property
+    def etag(self) -> str:
+        """Strong ETag of the identity encoding, known before anything is serialized.
 
-        For example
-
-        0.23.0-py27_0, 0.23.0-py27_1, 0.23.0-py36_0
-        ->
-        0.23.0-py27_1, 0.23.0-py36_0
+        The generations in the canonical key change with every upstream change, and
+        records are written in an order that only depends on the key: sorted names for
+        a closure, the upstream order otherwise.  So the same key always names the same
+        body, whichever process serialized it.
 
         """
-        keep_packages = []
-        packages_by_version = defaultdict(
-            lambda: SortedList(key=lambda o: -o[1].get("build_number", 0))
+        key = self.output_key
+        if key is not None:
+            raws, arch, names, functional = key
+            key = raws, arch, sorted(names) if names is not None else None, functional
+        return '"%s"' % hashlib.blake2b(repr(key).encode("utf8"), digest_size=32).hexdigest()
+
+    @property
+    def last_modified(self) -> str:
+        last_modified = self.raw.last_modified if self.output_key is not None else None
+        if last_modified:
+            return last_modified
+        # stays the same for every request of this generation, clients can revalidate it
+        with _first_built_lock:
+            last_modified = _first_built.get(self.etag)
+            if last_modified is None:
+                last_modified = _first_built[self.etag] = email.utils.formatdate(usegmt=True)
+        return last_modified
+
+    def repodata_output(self) -> "RepodataOutput":
+        return self._output_cache.get(
+            (self.output_key, "identity"), lambda previous: self._serialize()
         )
-        for k, v in packages.items():
-            build_string: str = v.get("build", "")
-            build_string, _, build_number = build_string.rpartition("_")
-
-            if not build_number.isnumeric():
-                keep_packages.append((k, v))
-            else:
-                packages_by_version[(v["version"], build_string)].add((k, v))
 
-        for version, ordered_builds in packages_by_version.items():
-            keep_packages.append(ordered_builds[0])
-
-        packages = dict(keep_packages)
-        return packages
-
-    def constrain_by_blacklist(self, packages, blacklist_name):
-        effective_blacklist = set()
-        for channel in self.raw.component_channels:
-            effective_blacklist.update(
-                get_blacklist(blacklist_name, channel, self.arch)
-            )
-        if len(effective_blacklist):
-            o = {k: v for k, v in packages.items() if k not in effective_blacklist}
-            logger.debug(
-                "constrained channel from {} to {} artifacts".format(
-                    len(packages), len(o)
-                )
-            )
-            return o
-        else:
-            return packages
-
-    def untrack_features(self, packages: dict) -> dict:
-        """TODO: This function edits the package information dictionary so that packages that are tracked are
-        instead replaced by the appropriate dependencies.
-
-        """
-        feature_map = {
-            "blas_openblas": "blas * openblas",
-            "blas_mkl": "blas * mkl",
-            "blas_nomkl": "blas * nomkl",
-            "vc9": "vs2008_runtime",
-            "vc10": "vs2010_runtime",
-            "vc14": "vs2015_runtime",
-        }
-
-        for k, v in packages.items():
-            features = v.get("features", "").split(" ")
-            kept_features = []
-            for feature in features:
-                if feature in feature_map:
-                    v["depends"].append(feature_map[feature])
-                else:
-                    kept_features.append(feature)
-            kept_features = " ".join(kept_features)
-            if kept_features:
-                v["features"] = kept_features
-            else:
-                v.pop("features", None)
-
-            # For feature packages get rid of mapped things
-            track_feature = v.get("track_features")
-            if track_feature in feature_map:
-                del v["track_features"]
+    def repodata_encoded(self, encoding: str) -> bytes:
+        """The output body in one of the COMPRESSORS, compressed once per output generation"""
+        if encoding == "identity":
+            return self.repodata_output().body
+        return self._output_cache.get(
+            (self.output_key, encoding),
+            lambda previous: compress(encoding, self.repodata_output().body),
+        )
 
-        return packages
+    def repodata_cached(self, encoding: str) -> typing.Optional[bytes]:
+        """The output body in ``encoding`` if it does not need to be serialized again"""
+        if (self.output_key, encoding) in self._output_cache:
+            return self.repodata_encoded(encoding)
+        return None
 
-    @cachedmethod(operator.attrgetter("_repodata_cache"))
     def repodata_json(self) -> str:
-        out_string = json.dumps(self.repodata_json_dict())
-        return out_string
+        return self.repodata_output().body.decode("utf8")
 
-    @cachedmethod(operator.attrgetter("_repodata_cache"))
     def repodata_json_bzip(self) -> bytes:
-        import bz2
+        return self.repodata_encoded("bz2")
+
+    def iter_body(self, chunk_size: int = 1 << 16) -> typing.Iterator[bytes]:
+        """Serialize the output incrementally, in chunks of about ``chunk_size`` bytes"""
+        if not self.constrained_names:
+            yield json.dumps(None).encode("utf8")
+            return
+        # The records are already serialized, only the envelope is left to write
+        chunk = bytearray(b'{"packages":{')
+        separator = b""
+        for filename, fragment in self.iter_records():
+            chunk += separator
+            chunk += json.dumps(filename).encode("utf8")
+            chunk += b":"
+            chunk += fragment
+            separator = b","
+            if len(chunk) >= chunk_size:
+                yield bytes(chunk)
+                chunk.clear()
+        chunk += b"}}"
+        yield bytes(chunk)
+
+    def iter_encoded(
+        self, encoding: str, future: typing.Optional[Future] = None
+    ) -> typing.Iterator[bytes]:
+        """Stream the output in ``encoding``, compressing it as it is serialized.
+
+        One request at a time builds an output, the chunks it streams land in the
+        output cache once exhausted.  Concurrent requests for the same output wait
+        for that body instead of serializing it again, so the build carries on to the
+        end even when the client of the leading request goes away.
+
+        ``future`` is that of a build claimed with ``claim_output``, which the stream
+        then leads.  A stream dropped before it started gives its claim up.
 
-        out_bytes = bz2.compress(self.repodata_json().encode("utf8"), compresslevel=1)
-        return out_bytes
+        """
+        key = (self.output_key, encoding)
+        if future is None:
+            leader, future = self.claim_output(encoding)
+            if not leader:
+                return self._follow_output(future)
+        stream = self._lead_output(encoding, future)
+        weakref.finalize(stream, self._drop_claim, key, future)
+        return stream
+
+    def claim_output(self, encoding: str) -> typing.Tuple[bool, Future]:
+        """Lead the build of the output in ``encoding``, or get the future of the one in flight"""
+        return self._output_cache.claim((self.output_key, encoding))
+
+    @staticmethod
+    def _follow_output(future: Future) -> typing.Iterator[bytes]:
+        value = future.result()
+        yield value.body if isinstance(value, RepodataOutput) else value
+
+    def _drop_claim(self, key, future: Future):
+        # called once the stream is gone, by then a stream that started has settled its claim
+        if not future.done():
+            self._output_cache.abandon(key, future, RuntimeError(f"build of {key} dropped"))
+
+    def _lead_output(self, encoding: str, future: Future) -> typing.Iterator[bytes]:
+        key = (self.output_key, encoding)
+        start = time.monotonic()
+        chunks = []
+        streaming = True
+        try:
+            for chunk in self._encode(encoding):
+                chunks.append(chunk)
+                if streaming:
+                    try:
+                        yield chunk
+                    except GeneratorExit:
+                        # finish the build for the requests waiting on it
+                        streaming = False
+        except BaseException as e:
+            self._output_cache.abandon(key, future, e)
+            raise
+
+        body = b"".join(chunks)
+        del chunks
+        # includes the time the client took to read the chunks
+        metrics.observe("stream", time.monotonic() - start, len(body))
+        if encoding == "identity":
+            body = RepodataOutput(body, self.etag, self.last_modified)
+        self._output_cache.fulfil(key, body, time.monotonic() - start, future)
+
+    def _encode(self, encoding: str) -> typing.Iterator[bytes]:
+        compressor = COMPRESSORS[encoding]() if encoding != "identity" else None
+        for chunk in self.iter_body():
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        if compressor is not None:
+            yield compressor.flush()
+
+    def output_inflight(self, encoding: str) -> typing.Optional[Future]:
+        """The future of the output in ``encoding`` while it is being built"""
+        return self._output_cache.inflight((self.output_key, encoding))
+
+    def _serialize(self) -> "RepodataOutput":
+        with metrics.phase("serialize") as timed:
+            body = b"".join(self.iter_body())
+            timed.size = len(body)
+        return RepodataOutput(body, self.etag, self.last_modified)
+
+
+class RepodataOutput(typing.NamedTuple):
+    """One generation of a serialized repodata, with the validators to revalidate it"""
+
+    body: bytes
+    # strong ETag of the identity encoding
+    etag: str
+    last_modified: str
+
+    def etag_for(self, encoding: str) -> str:
+        return etag_for(self.etag, encoding)
+
+
+def etag_for(etag: str, encoding: str) -> str:
+    """Tell the encodings of an output apart, their bodies differ"""
+    if encoding == "identity":
+        return etag
+    return f'{etag[:-1]}+{encoding}"'
+
+
+def _output_size(value) -> int:
+    if isinstance(value, RepodataOutput):
+        return len(value.body)
+    return len(value)
+
+
+def _gzip():
+    # zlib writes a gzip header without a timestamp, keeping the encoding deterministic
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+# Incremental compressors of the encodings we serve, by content coding
+COMPRESSORS = {
+    "bz2": lambda: bz2.BZ2Compressor(1),
+    "gzip": _gzip,
+}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    """Compress a whole body in one of the COMPRESSORS"""
+    with metrics.phase("compress") as timed:
+        compressor = COMPRESSORS[encoding]()
+        body = compressor.compress(body) + compressor.flush()
+        timed.size = len(body)
+    return body
 
 
 def get_artifact_graph(
@@ -432,32 +1092,124 @@ def get_artifact_graph(
     if isinstance(constraints, str):
         constraints = [constraints]
 
-    # Special handling for defaults because it is special
-    if "defaults" in channel:
-        if arch == "win-64":
-            new_channel = [
-                "https://repo.anaconda.com/pkgs/main",
-                "https://repo.anaconda.com/pkgs/msys",
-                "https://repo.anaconda.com/pkgs/r",
-            ]
-        else:
-            new_channel = [
-                "https://repo.anaconda.com/pkgs/main",
-                "https://repo.anaconda.com/pkgs/r",
-            ]
-        idx = channel.index("defaults")
-        channel = channel[:idx] + new_channel + channel[idx + 1 :]
+    channel = expand_channels(channel, arch)
 
     print(f"Using channel {channel}")
 
-    key = (tuple(channel), arch, tuple(sorted(constraints)), repodata_file)
-    agcache = ArtifactGraph.artifact_graph_cache()
-    if key not in agcache:
-        agcache[key] = ArtifactGraph(
+    key = _artifact_graph_key(channel, arch, constraints, repodata_file)
+    build = _artifact_graph_builder(channel, arch, constraints, repodata_file, base_url)
+    return ArtifactGraph.artifact_graph_cache().get(key, build)
+
+
+def _artifact_graph_key(channel, arch, constraints, repodata_file) -> tuple:
+    return tuple(channel), arch, tuple(sorted(constraints)), repodata_file
+
+
+def _artifact_graph_builder(channel, arch, constraints, repodata_file, base_url):
+    def build(previous):
+        return ArtifactGraph(
             channel=channel,
             arch=arch,
             constraints=constraints,
             repodata_file=repodata_file,
             base_url=base_url,
         )
-    return agcache[key]
+
+    return build
+
+
+def warm_artifact_graph(
+    channel: typing.List[str],
+    arch: str,
+    constraints,
+    repodata_file: str,
+    encodings: typing.Iterable[str] = ("identity",),
+    base_url: str = DEFAULT_BASE_URL,
+    margin: float = 60,
+) -> ArtifactGraph:
+    """Rebuild a graph and its outputs if they would expire within ``margin`` seconds.
+
+    The channels are revalidated first, so that the new graph starts its life fresh,
+    then the outputs are serialized in every encoding in ``encodings``.
+
+    """
+    if isinstance(constraints, str):
+        constraints = [constraints]
+    channel = expand_channels(channel, arch)
+    noarch = "noarch" if arch != "noarch" else "linux-64"
+
+    def expiring(cache, key):
+        age = cache.age(key)
+        return age is None or age > cache.ttl - margin
+
+    for c in channel:
+        for a in (arch, noarch):
+            key = (c, a, source_file(repodata_file))
+            if expiring(RawRepoData._cache, key):
+                logger.info(f"WARMING {key}")
+                RawRepoData._cache.refresh(key, _raw_repo_data_builder(key, base_url))
+
+    key = _artifact_graph_key(channel, arch, constraints, repodata_file)
+    graph_cache = ArtifactGraph.artifact_graph_cache()
+    build = _artifact_graph_builder(channel, arch, constraints, repodata_file, base_url)
+    if expiring(graph_cache, key):
+        logger.info(f"WARMING {key}")
+        ag = graph_cache.refresh(key, build)
+    else:
+        ag = graph_cache.get(key, build)
+    # outputs are keyed on generations, those of unchanged channels are still cached
+    for encoding in encodings:
+        ag.repodata_encoded(encoding)
+    return ag
+
+
+def is_artifact_graph_cached(
+    channel: typing.List[str], arch: str, constraints, repodata_file: str
+) -> bool:
+    """Whether get_artifact_graph would answer without building anything"""
+    if isinstance(constraints, str):
+        constraints = [constraints]
+    channel = expand_channels(channel, arch)
+    key = _artifact_graph_key(channel, arch, constraints, repodata_file)
+    return key in ArtifactGraph._artifact_graph_cache
+
+
+def builds_inflight(
+    channel: typing.List[str], arch: str, constraints, repodata_file: str
+) -> typing.List[Future]:
+    """The futures of the builds in flight that get_artifact_graph would wait for"""
+    if isinstance(constraints, str):
+        constraints = [constraints]
+    channel = expand_channels(channel, arch)
+    noarch = "noarch" if arch != "noarch" else "linux-64"
+    keys = [(c, a, source_file(repodata_file)) for a in (arch, noarch) for c in channel]
+    futures = [RawRepoData._cache.inflight(key) for key in keys]
+    key = _artifact_graph_key(channel, arch, constraints, repodata_file)
+    futures.append(ArtifactGraph._artifact_graph_cache.inflight(key))
+    return [future for future in futures if future is not None]
+
+
+def is_repo_data_cached(
+    channel: typing.List[str], arch: str, repodata_file: str = REPODATA_FILE
+) -> bool:
+    """Whether get_repo_data would answer without fetching anything"""
+    channel = expand_channels(channel, arch)
+    return all((c, arch, repodata_file) in RawRepoData._cache for c in channel)
+
+
+def get_artifact_url(
+    channel: typing.List[str],
+    arch: str,
+    artifact: str,
+    repodata_file: str = REPODATA_FILE,
+    base_url: str = DEFAULT_BASE_URL,
+) -> typing.Optional[str]:
+    """Resolve the upstream url of an artifact without building an ArtifactGraph"""
+    channel = expand_channels(channel, arch)
+    fused = get_repo_data(
+        channel=channel, arch=arch, base_url=base_url, repodata_file=repodata_file
+    )
+    found = fused.lookup_artifact(artifact)
+    if found is None:
+        return None
+    return found[1]
@@ -0,0 +1,490 @@
+import struct
+import sys
+import typing
+from array import array
+from logging import getLogger
+
+from pandas.io import json
+
+import ingest
+from versions import MatchSpec, version_order
+
+logger = getLogger(__name__)
+
+# Record flags
+FEATURES = 1  # the record has features or track_features
+
+# Serialized layout, see PackageIndex.to_bytes
+_MAGIC = b"MCPI\x01\x00\x00\x00"
+_HEADER = struct.Struct("<q")
+_ALIGN = 8
+# Size of the slices a payload is fed to the parser in
+_CHUNK = 1 << 16
+_SECTIONS = (
+    ("record_name", "i"),
+    ("build_numbers", "q"),
+    ("record_deps_start", "i"),
+    ("record_deps", "i"),
+    ("name_records", "i"),
+    ("name_deps_start", "i"),
+    ("name_deps", "i"),
+    ("fragment_offsets", "q"),
+    ("fragment_lengths", "q"),
+    ("flags", "B"),
+    ("blob", "B"),
+)
+
+
+class PackageIndex:
+    """Compact, read-only index of the packages of one channel subdir.
+
+    Package names are interned to integer ids, every name that is only ever
+    depended upon gets one too.  Records are stored column-wise and sorted by name:
+
+    * the records of name ``i`` are ``name_records[i]:name_records[i + 1]``
+    * the dependency names of record ``r`` are the ids
+      ``record_deps[record_deps_start[r]:record_deps_start[r + 1]]``, and ``name_deps``
+      holds the union of those over all the records of a name in the same layout
+    * the full record, url included, is kept as a serialized JSON fragment in ``blob``
+
+    """
+
+    __slots__ = (
+        "arch",
+        "url_prefix",
+        "names",
+        "name_ids",
+        "name_records",
+        "name_deps_start",
+        "name_deps",
+        "record_name",
+        "filenames",
+        "versions",
+        "builds",
+        "build_numbers",
+        "flags",
+        "record_deps_start",
+        "record_deps",
+        "fragment_offsets",
+        "fragment_lengths",
+        "blob",
+        "artifact_ids",
+        "nbytes",
+        "_latest_builds",
+        "_current",
+        "_rewritten",
+    )
+
+    def __init__(self):
+        self._latest_builds = None
+        self._current = None
+        self._rewritten = {}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, name: str):
+        return name in self.name_ids
+
+    def __repr__(self):
+        return f"PackageIndex({self.url_prefix!r}, {len(self)} records)"
+
+    def records_of(self, name: str) -> range:
+        i = self.name_ids.get(name)
+        if i is None:
+            return range(0)
+        return range(self.name_records[i], self.name_records[i + 1])
+
+    def has_records(self, name: str) -> bool:
+        return len(self.records_of(name)) > 0
+
+    def dependency_names(self, name: str) -> typing.List[str]:
+        i = self.name_ids[name]
+        names = self.names
+        deps = self.name_deps
+        return [names[d] for d in deps[self.name_deps_start[i] : self.name_deps_start[i + 1]]]
+
+    def record_dependency_ids(self, rid: int) -> array:
+        return self.record_deps[self.record_deps_start[rid] : self.record_deps_start[rid + 1]]
+
+    def name_of(self, rid: int) -> str:
+        return self.names[self.record_name[rid]]
+
+    def fragment(self, rid: int) -> bytes:
+        offset = self.fragment_offsets[rid]
+        return bytes(self.blob[offset : offset + self.fragment_lengths[rid]])
+
+    def record(self, rid: int) -> dict:
+        return json.loads(self.fragment(rid))
+
+    def rewritten(self, rid: int, rewrite: typing.Callable[[dict], dict]) -> bytes:
+        """The fragment of ``rid`` as changed by ``rewrite``, serialized once per index.
+
+        ``rewrite`` returns a new record rather than editing the one it is given, the
+        records of the index are shared by every metachannel over this generation.
+
+        """
+        key = (rewrite, rid)
+        fragment = self._rewritten.get(key)
+        if fragment is None:
+            fragment = json.dumps(rewrite(self.record(rid))).encode("utf8")
+            self._rewritten[key] = fragment
+        return fragment
+
+    @property
+    def latest_builds(self) -> bytes:
+        """Mask of the records ``latest_builds`` keeps, computed once per index"""
+        if self._latest_builds is None:
+            mask = bytearray(len(self))
+            for i in range(len(self.names)):
+                rids = range(self.name_records[i], self.name_records[i + 1])
+                for rid in latest_builds(self, rids):
+                    mask[rid] = 1
+            self._latest_builds = bytes(mask)
+        return self._latest_builds
+
+    @property
+    def current(self) -> bytes:
+        """Mask of the records of a ``current_repodata.json``, computed once per index.
+
+        Those are the top builds of the latest version of every package, then for every
+        dependency of those the latest version meeting it, when no record we keep does.
+
+        """
+        if self._current is None:
+            mask = bytearray(len(self))
+            todo = []
+
+            def keep(rids):
+                rids = [r for r in rids if not mask[r]]
+                if not rids:
+                    return
+                top = max(version_order(self.versions[r]) for r in rids)
+                rids = [r for r in rids if version_order(self.versions[r]) == top]
+                for rid in latest_builds(self, rids):
+                    mask[rid] = 1
+                    todo.append(rid)
+
+            for i in range(len(self.names)):
+                keep(range(self.name_records[i], self.name_records[i + 1]))
+            # a dependency met once stays met as the mask only grows
+            seen = set()
+            while todo:
+                for dep in self.record(todo.pop()).get("depends", ()):
+                    if dep in seen:
+                        continue
+                    seen.add(dep)
+                    try:
+                        spec = MatchSpec.parse(dep)
+                    except ValueError:
+                        continue
+                    rids = [
+                        r
+                        for r in self.records_of(spec.name)
+                        if spec.match(self.versions[r], self.builds[r])
+                    ]
+                    if not any(mask[r] for r in rids):
+                        keep(rids)
+            self._current = bytes(mask)
+        return self._current
+
+    def to_bytes(self) -> bytearray:
+        """Serialize the index so that ``from_bytes`` can use it without copying it.
+
+        The strings go in a JSON header, every array follows it as raw machine data
+        aligned on 8 bytes, ending with the records' blob.
+
+        """
+        sections = [(name, code, getattr(self, name)) for name, code in _SECTIONS]
+        header = json.dumps(
+            {
+                "arch": self.arch,
+                "url_prefix": self.url_prefix,
+                "names": self.names,
+                "filenames": self.filenames,
+                "versions": self.versions,
+                "builds": self.builds,
+                "lengths": [len(data) for _, _, data in sections],
+            }
+        ).encode("utf8")
+        out = bytearray(_MAGIC)
+        out += _HEADER.pack(len(header))
+        out += header
+        for _, _, data in sections:
+            out += bytes(-len(out) % _ALIGN)
+            out += data
+        return out
+
+    @classmethod
+    def from_bytes(cls, buffer) -> "PackageIndex":
+        """Load an index written by ``to_bytes``, its arrays stay views on ``buffer``"""
+        view = memoryview(buffer).cast("B")
+        if view[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("not a serialized PackageIndex")
+        offset = len(_MAGIC) + _HEADER.size
+        (size,) = _HEADER.unpack_from(view, len(_MAGIC))
+        header = json.loads(bytes(view[offset : offset + size]))
+        offset += size
+
+        index = cls()
+        index.arch = header["arch"]
+        index.url_prefix = header["url_prefix"]
+        index.names = header["names"]
+        index.name_ids = {name: i for i, name in enumerate(index.names)}
+        index.filenames = header["filenames"]
+        strings = {}
+        index.versions = [strings.setdefault(v, v) for v in header["versions"]]
+        index.builds = header["builds"]
+        index.artifact_ids = {fn: rid for rid, fn in enumerate(index.filenames)}
+        for (name, code), length in zip(_SECTIONS, header["lengths"]):
+            offset += -offset % _ALIGN
+            end = offset + length * struct.calcsize(code)
+            setattr(index, name, view[offset:end].cast(code))
+            offset = end
+        index.nbytes = _measure(index)
+        return index
+
+    @classmethod
+    def from_packages(
+        cls,
+        packages: typing.Iterable[typing.Tuple[str, dict]],
+        arch: str,
+        url_prefix: str,
+    ) -> "PackageIndex":
+        """Index ``(filename, record)`` pairs, consuming them one at a time"""
+        builder = _IndexBuilder(arch, url_prefix)
+        for p, v in packages:
+            v["url"] = f"{url_prefix}/{p}"
+            flags = FEATURES if ("features" in v or "track_features" in v) else 0
+            builder.add(
+                p,
+                v["name"],
+                v.get("version", ""),
+                v.get("build", ""),
+                v.get("build_number", 0),
+                [dep.partition(" ")[0] for dep in v.get("depends", ())],
+                json.dumps(v).encode("utf8"),
+                flags,
+            )
+        return builder.finish()
+
+
+class LayeredIndex:
+    """Read-only view fusing several PackageIndex of the same subdir without copying them.
+
+    A later layer that has records for a package name shadows that name in all the
+    earlier layers.  Priority is resolved on lookup, so the layers stay shared with
+    every other view and cache that uses them.
+
+    """
+
+    __slots__ = ("layers",)
+
+    def __init__(self, layers: typing.Sequence[PackageIndex]):
+        self.layers = tuple(layers)
+
+    def __contains__(self, name: str):
+        return any(name in layer for layer in self.layers)
+
+    def __repr__(self):
+        return f"LayeredIndex({list(self.layers)!r})"
+
+    @property
+    def names(self) -> typing.List[str]:
+        if len(self.layers) == 1:
+            return self.layers[0].names
+        return list(dict.fromkeys(n for layer in self.layers for n in layer.names))
+
+    def owner(self, name: str) -> typing.Optional[PackageIndex]:
+        """The layer whose records are served for ``name``"""
+        for layer in reversed(self.layers):
+            if layer.has_records(name):
+                return layer
+        return None
+
+    def records_of(self, name: str) -> typing.Tuple[typing.Optional[PackageIndex], range]:
+        layer = self.owner(name)
+        if layer is None:
+            return None, range(0)
+        return layer, layer.records_of(name)
+
+    def dependency_names(self, name: str) -> typing.List[str]:
+        # records of shadowed layers are never served, so neither are their dependencies
+        layer = self.owner(name)
+        if layer is None:
+            return []
+        return layer.dependency_names(name)
+
+
+class _IndexBuilder:
+    """Accumulates records in arrival order and sorts them by name on ``finish``"""
+
+    def __init__(self, arch: str, url_prefix: str):
+        self.arch = arch
+        self.url_prefix = url_prefix
+        self.names = []
+        self.name_ids = {}
+        self.record_name = array("i")
+        self.filenames = []
+        self.versions = []
+        self.builds = []
+        self.build_numbers = array("q")
+        self.flags = bytearray()
+        self.deps = []
+        self.fragment_offsets = array("q")
+        self.fragment_lengths = array("q")
+        self.blob = bytearray()
+        # versions repeat a lot across builds and names
+        self._strings = {}
+
+    def intern(self, name: str) -> int:
+        i = self.name_ids.get(name)
+        if i is None:
+            i = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def add(self, filename, name, version, build, build_number, dep_names, fragment, flags):
+        self.record_name.append(self.intern(name))
+        self.filenames.append(filename)
+        self.versions.append(self._strings.setdefault(version, version))
+        self.builds.append(build)
+        self.build_numbers.append(build_number)
+        self.flags.append(flags)
+        self.deps.append(tuple(dict.fromkeys(self.intern(d) for d in dep_names)))
+        self.fragment_offsets.append(len(self.blob))
+        self.fragment_lengths.append(len(fragment))
+        self.blob += fragment
+
+    def finish(self) -> PackageIndex:
+        n_names = len(self.names)
+        order = sorted(range(len(self.filenames)), key=self.record_name.__getitem__)
+
+        index = PackageIndex()
+        index.arch = self.arch
+        index.url_prefix = self.url_prefix
+        index.names = self.names
+        index.name_ids = self.name_ids
+        index.record_name = array("i", (self.record_name[r] for r in order))
+        index.filenames = [self.filenames[r] for r in order]
+        index.versions = [self.versions[r] for r in order]
+        index.builds = [self.builds[r] for r in order]
+        index.build_numbers = array("q", (self.build_numbers[r] for r in order))
+        index.flags = bytes(self.flags[r] for r in order)
+        index.fragment_offsets = array("q", (self.fragment_offsets[r] for r in order))
+        index.fragment_lengths = array("q", (self.fragment_lengths[r] for r in order))
+        index.blob = self.blob
+        index.artifact_ids = {fn: rid for rid, fn in enumerate(index.filenames)}
+
+        index.record_deps_start = array("i", [0])
+        index.record_deps = array("i")
+        for r in order:
+            index.record_deps.extend(self.deps[r])
+            index.record_deps_start.append(len(index.record_deps))
+
+        index.name_records = array("i", [0] * (n_names + 1))
+        for i in index.record_name:
+            index.name_records[i + 1] += 1
+        for i in range(n_names):
+            index.name_records[i + 1] += index.name_records[i]
+
+        index.name_deps_start = array("i", [0])
+        index.name_deps = array("i")
+        for i in range(n_names):
+            deps = {}
+            for rid in range(index.name_records[i], index.name_records[i + 1]):
+                deps.update(dict.fromkeys(index.record_dependency_ids(rid)))
+            index.name_deps.extend(deps)
+            index.name_deps_start.append(len(index.name_deps))
+        index.nbytes = _measure(index)
+        return index
+
+
+def latest_builds(index: PackageIndex, rids) -> typing.List[int]:
+    """Of the records of a package only keep the top build number of every build string
+
+    Packages without a build number (such as the blas mutex package are unaffected)
+
+    For example
+
+    0.23.0-py27_0, 0.23.0-py27_1, 0.23.0-py36_0
+    ->
+    0.23.0-py27_1, 0.23.0-py36_0
+
+    """
+    keep = set()
+    best = {}
+    for rid in rids:
+        build_string, _, build_number = index.builds[rid].rpartition("_")
+        if not build_number.isnumeric():
+            keep.add(rid)
+            continue
+        key = (index.versions[rid], build_string)
+        top = best.get(key)
+        if top is None or index.build_numbers[rid] > index.build_numbers[top]:
+            best[key] = rid
+    keep.update(best.values())
+    return [rid for rid in rids if rid in keep]
+
+
+def _measure(index: PackageIndex) -> int:
+    """Approximate memory held by ``index``, for the cache budget; interned versions are shared"""
+    return (
+        len(index.blob)
+        + len(index.flags)
+        + sum(
+            a.itemsize * len(a)
+            for a in (
+                index.record_name,
+                index.build_numbers,
+                index.fragment_offsets,
+                index.fragment_lengths,
+                index.record_deps_start,
+                index.record_deps,
+                index.name_records,
+                index.name_deps_start,
+                index.name_deps,
+            )
+        )
+        + sum(map(sys.getsizeof, index.filenames))
+        + sum(map(sys.getsizeof, index.builds))
+        + sum(map(sys.getsizeof, index.names))
+        + sys.getsizeof(index.artifact_ids)
+        + sys.getsizeof(index.name_ids)
+        + 3 * 8 * len(index.filenames)
+    )
+
+
+def index_payload(payload: bytes, compressed: bool, arch: str, url_prefix: str) -> bytearray:
+    """Index a complete repodata payload and serialize the result.
+
+    Meant to run in a worker process, the serialized index is cheap to send back.
+
+    """
+    view = memoryview(payload)
+    chunks = (view[i : i + _CHUNK] for i in range(0, len(view), _CHUNK))
+    packages = ingest.iter_packages(chunks, compressed)
+    return PackageIndex.from_packages(packages, arch, url_prefix).to_bytes()
+
+
+def changed_names(old: PackageIndex, new: PackageIndex) -> typing.FrozenSet[str]:
+    """Names of the packages whose records differ between two generations of an index"""
+    changed = set()
+    old_blob = memoryview(old.blob)
+    new_blob = memoryview(new.blob)
+    for rid, filename in enumerate(new.filenames):
+        old_rid = old.artifact_ids.get(filename)
+        if old_rid is None:
+            changed.add(new.name_of(rid))
+            continue
+        length = new.fragment_lengths[rid]
+        if length != old.fragment_lengths[old_rid]:
+            changed.add(new.name_of(rid))
+            continue
+        offset, old_offset = new.fragment_offsets[rid], old.fragment_offsets[old_rid]
+        if new_blob[offset : offset + length] != old_blob[old_offset : old_offset + length]:
+            changed.add(new.name_of(rid))
+    for rid, filename in enumerate(old.filenames):
+        if filename not in new.artifact_ids:
+            changed.add(old.name_of(rid))
+    return frozenset(changed)
@@ -0,0 +1,122 @@
+import bz2
+import codecs
+import json
+import re
+import typing
+
+_WS = re.compile(r"[ \t\n\r]*")
+# what a number cut at the end of a chunk may be followed by in the next one
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+_DECODER = json.JSONDecoder()
+
+
+class _Reader:
+    """Reads JSON values one at a time out of a stream of text chunks"""
+
+    def __init__(self, texts: typing.Iterable[str]):
+        self._texts = iter(texts)
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        for text in self._texts:
+            if text:
+                self.buf = self.buf[self.pos :] + text
+                self.pos = 0
+                return True
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of repodata")
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} in repodata at {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk, even when
+            # the part decoded so far is followed by what can only be more of it, e.g. "1."
+            if (
+                isinstance(value, (int, float))
+                and _NUMBER_TAIL.match(self.buf, end).end() == len(self.buf)
+                and not self.eof
+                and self._fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+    def members(self) -> typing.Iterator[str]:
+        """Yield the keys of the object being read, the caller has to consume each value"""
+        first = True
+        while True:
+            char = self.peek()
+            if char == "}":
+                self.pos += 1
+                return
+            if not first:
+                self.expect(",")
+            first = False
+            key = self.value()
+            self.expect(":")
+            yield key
+
+    def finish(self):
+        while self.pos < len(self.buf) or self._fill():
+            if _WS.match(self.buf, self.pos).end() != len(self.buf):
+                raise ValueError("trailing data after repodata")
+            self.pos = len(self.buf)
+
+
+def iter_text(
+    chunks: typing.Iterable[bytes], compressed: bool
+) -> typing.Iterator[str]:
+    """Decompress and decode a repodata payload chunk by chunk"""
+    decompressor = bz2.BZ2Decompressor() if compressed else None
+    decoder = codecs.getincrementaldecoder("utf8")()
+    for chunk in chunks:
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def iter_packages(
+    chunks: typing.Iterable[bytes], compressed: bool
+) -> typing.Iterator[typing.Tuple[str, dict]]:
+    """Yield the ``(filename, record)`` pairs of the ``packages`` of a repodata payload.
+
+    Only one record is materialized at a time, the other sections of the repodata
+    are read and dropped as they stream by.
+
+    """
+    reader = _Reader(iter_text(chunks, compressed))
+    reader.expect("{")
+    for key in reader.members():
+        if reader.peek() != "{":
+            reader.value()
+            continue
+        reader.expect("{")
+        if key == "packages":
+            for filename in reader.members():
+                yield filename, reader.value()
+        else:
+            for _ in reader.members():
+                reader.value()
+    reader.finish()
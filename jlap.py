@@ -0,0 +1,102 @@
+import hashlib
+import threading
+import typing
+from logging import getLogger
+
+from cachetools import LRUCache
+from pandas.io import json
+
+logger = getLogger(__name__)
+
+# Patches kept per metachannel, clients further behind download the full repodata
+MAX_PATCHES = 32
+
+
+def _hash(data: bytes, key: bytes = b"") -> bytes:
+    return hashlib.blake2b(data, digest_size=32, key=key).digest()
+
+
+def _pointer(filename: str) -> str:
+    # JSON Pointer escaping, RFC 6901
+    return "/packages/" + filename.replace("~", "~0").replace("/", "~1")
+
+
+class PatchFeed:
+    """A ``repodata.jlap`` feed of JSON Patches between the generations of one metachannel.
+
+    Every patch takes a repodata.json whose blake2b-256 is ``from`` to the one whose
+    hash is ``to``.  Each line of the feed is chained to the previous one with a keyed
+    blake2b checksum, starting from the checksum on the first line and ending with
+    the checksum of the footer, so that clients can fetch and verify only the tail.
+
+    """
+
+    def __init__(self, max_patches: int = MAX_PATCHES):
+        self.max_patches = max_patches
+        self.lock = threading.Lock()
+        self.output_key = None
+        # hash of the latest repodata.json and digests of its records
+        self.latest: typing.Optional[str] = None
+        self.digests: typing.Dict[str, bytes] = {}
+        # checksum preceding the first kept line
+        self.iv = bytes(32)
+        # (line, checksum up to and including it)
+        self.lines: typing.List[typing.Tuple[bytes, bytes]] = []
+
+    def update(self, ag) -> bool:
+        """Append the patch to the output of ``ag`` if it is a new generation"""
+        with self.lock:
+            if ag.output_key == self.output_key or not ag.constrained_names:
+                return False
+            latest = _hash(ag.repodata_output().body).hex()
+            digests = {}
+            patch = []
+            for filename, fragment in ag.iter_records():
+                digest = digests[filename] = hashlib.blake2b(fragment, digest_size=16).digest()
+                if self.digests.get(filename) != digest:
+                    patch.append(
+                        {"op": "add", "path": _pointer(filename), "value": json.loads(fragment)}
+                    )
+            for filename in self.digests:
+                if filename not in digests:
+                    patch.append({"op": "remove", "path": _pointer(filename)})
+
+            if self.latest is not None and latest != self.latest:
+                line = json.dumps({"from": self.latest, "to": latest, "patch": patch})
+                self._append(line.encode("utf8"))
+                logger.info(f"PATCH OF {len(patch)} OPERATIONS FOR {ag}")
+            self.output_key = ag.output_key
+            self.latest = latest
+            self.digests = digests
+            return True
+
+    def _append(self, line: bytes):
+        previous = self.lines[-1][1] if self.lines else self.iv
+        self.lines.append((line, _hash(line, previous)))
+        while len(self.lines) > self.max_patches:
+            _, self.iv = self.lines.pop(0)
+
+    def render(self, url: str = "repodata.json") -> bytes:
+        with self.lock:
+            lines = [self.iv.hex().encode("ascii")]
+            checksum = self.iv
+            for line, checksum in self.lines:
+                lines.append(line)
+            footer = json.dumps({"url": url, "latest": self.latest}).encode("utf8")
+            lines.append(footer)
+            lines.append(_hash(footer, checksum).hex().encode("ascii"))
+        return b"\n".join(lines) + b"\n"
+
+
+# (channel, constraints, arch, repodata_file) -> PatchFeed, only for the metachannels
+# clients asked a feed for
+_feeds = LRUCache(64)
+_feeds_lock = threading.Lock()
+
+
+def get_feed(key: tuple, create: bool = False) -> typing.Optional[PatchFeed]:
+    with _feeds_lock:
+        feed = _feeds.get(key)
+        if feed is None and create:
+            feed = _feeds[key] = PatchFeed()
+        return feed
@@ -0,0 +1,172 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+import typing
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Whether the phases of requests are timed, see --metrics.  Disabled, timing a phase
+# costs a function call.
+ENABLED = False
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1 << n for n in range(10, 31, 2))
+
+
+class Histogram:
+    """A Prometheus histogram, ``buckets`` are the upper bounds of its buckets"""
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class Timings:
+    """The phases of one request, for its Server-Timing header"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: typing.Dict[str, float] = {}
+
+    def header(self) -> str:
+        phases = {**self.phases, "total": time.perf_counter() - self.start}
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items())
+
+
+_lock = threading.Lock()
+# phase -> histogram of its durations, and of its sizes for the phases that have one
+_seconds: typing.Dict[str, Histogram] = {}
+_bytes: typing.Dict[str, Histogram] = {}
+# Timings of the request being served, threads it hands work to see them through bind
+_timings: contextvars.ContextVar[typing.Optional[Timings]] = contextvars.ContextVar(
+    "timings", default=None
+)
+
+
+def observe(name: str, seconds: float, size: typing.Optional[int] = None):
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = _seconds.get(name)
+        if histogram is None:
+            histogram = _seconds[name] = Histogram(SECONDS_BUCKETS)
+        histogram.observe(seconds)
+        if size is not None:
+            histogram = _bytes.get(name)
+            if histogram is None:
+                histogram = _bytes[name] = Histogram(BYTES_BUCKETS)
+            histogram.observe(size)
+    timings = _timings.get()
+    if timings is not None:
+        # phases running on several threads at once add up
+        timings.phases[name] = timings.phases.get(name, 0.0) + seconds
+
+
+class _Phase:
+    __slots__ = ("name", "size", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.size = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start, self.size)
+
+
+class _Untimed:
+    # the phase of every block while timing is disabled, sizes set on it are dropped
+    size = property(lambda self: None, lambda self, size: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_UNTIMED = _Untimed()
+
+
+def phase(name: str):
+    """Time the block as phase ``name``, set ``size`` on what it yields to record a size"""
+    if not ENABLED:
+        return _UNTIMED
+    return _Phase(name)
+
+
+def start_request() -> typing.Optional[Timings]:
+    """Time the phases of the current request"""
+    if not ENABLED:
+        return None
+    timings = Timings()
+    _timings.set(timings)
+    return timings
+
+
+def request_timings() -> typing.Optional[Timings]:
+    return _timings.get()
+
+
+def bind(func: typing.Callable) -> typing.Callable:
+    """``func`` running in a copy of the current context, for executors that do not copy it"""
+    if not ENABLED:
+        return func
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def _labels(labels: dict) -> str:
+    return ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels.items()
+    )
+
+
+def render(
+    families: typing.Iterable[
+        typing.Tuple[str, str, str, typing.Iterable[typing.Tuple[dict, float]]]
+    ]
+) -> str:
+    """The Prometheus text exposition of ``families``, then of the phase histograms.
+
+    Every family is a ``(name, type, help, samples)`` tuple, whose samples are
+    ``(labels, value)`` pairs.
+
+    """
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{_labels(labels)}}} {value}" if labels else f"{name} {value}")
+    with _lock:
+        for name, histograms, help in (
+            ("metachannel_phase_seconds", _seconds, "Time spent in every phase of a request"),
+            ("metachannel_phase_bytes", _bytes, "Size of what phases produce"),
+        ):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for phase_name, histogram in sorted(histograms.items()):
+                lines.extend(histogram.samples(name, _labels({"phase": phase_name})))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,133 @@
+import hashlib
+import re
+import threading
+import time
+import typing
+from logging import getLogger
+
+from cachetools import LRUCache
+from pandas.io import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from cache import BuildCache
+from graph import ArtifactGraph
+
+logger = getLogger(__name__)
+
+# Sharded repodata (CEP 16) is msgpack compressed with zstd, without either it is not served
+AVAILABLE = msgpack is not None and zstandard is not None
+SHARDS_INDEX = "repodata_shards.msgpack.zst"
+SHARD_NAME = re.compile(r"^([0-9a-f]{64})\.msgpack\.zst$")
+
+# sha256 of the compressed shard -> compressed shard, shared by every metachannel
+_shards = BuildCache("shard", ttl=float("inf"), sizeof=len)
+# output key -> serialized shards index
+_indexes = BuildCache("shard_index", ttl=float("inf"), sizeof=len)
+# ((url, generation) of every channel of both subdirs, name, functional constraints)
+# -> sha256 of its shard, so that other metachannels skip compressing it again.  Pins
+# read the records of other packages and blacklists those of every channel, so a shard
+# only depends on all of them.
+_digests = LRUCache(1 << 16)
+_digests_lock = threading.Lock()
+
+
+def _pack(obj) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(msgpack.packb(obj, use_bin_type=True))
+
+
+def _record(fragment: bytes) -> dict:
+    record = json.loads(fragment)
+    # shards hold the hashes as bytes
+    for key in ("md5", "sha256"):
+        if isinstance(record.get(key), str):
+            try:
+                record[key] = bytes.fromhex(record[key])
+            except ValueError:
+                pass
+    return record
+
+
+def _shard(ag: ArtifactGraph, name: str) -> typing.Optional[bytes]:
+    packages = {}
+    conda_packages = {}
+    for fn, fragment in ag.records_of(name):
+        (conda_packages if fn.endswith(".conda") else packages)[fn] = _record(fragment)
+    if not packages and not conda_packages:
+        return None
+    return _pack({"packages": packages, "packages.conda": conda_packages, "removed": []})
+
+
+def build_index(ag: ArtifactGraph) -> bytes:
+    """Shard the output of ``ag`` per package name and index the shards by their sha256.
+
+    Every shard is stored in the shard cache, where it is shared with the other
+    metachannels serving the very same records for that name.
+
+    """
+    sources = tuple(
+        (raw.repodata_url, raw.generation)
+        for raw in (*ag.raw.raw_repodata, *ag.noarch.raw_repodata)
+    )
+    functional = ag.output_key[3]
+    shards = {}
+    for name in sorted(ag.constrained_names):
+        layer = ag.raw.index.owner(name)
+        if layer is None:
+            # only served by the other subdir
+            continue
+        key = (sources, name, functional)
+        with _digests_lock:
+            digest = _digests.get(key)
+        if digest is None or digest not in _shards:
+            start = time.monotonic()
+            shard = _shard(ag, name)
+            if shard is None:
+                continue
+            digest = hashlib.sha256(shard).hexdigest()
+            _shards.put(digest, shard, time.monotonic() - start)
+            with _digests_lock:
+                _digests[key] = digest
+        shards[name] = digest
+    logger.info(f"SHARDED {ag} IN {len(shards)} SHARDS")
+    return _pack(
+        {
+            "version": 1,
+            # packages and shards are both served next to the index
+            "info": {"subdir": ag.arch, "base_url": "./", "shards_base_url": "./"},
+            "shards": {name: bytes.fromhex(digest) for name, digest in shards.items()},
+        }
+    )
+
+
+def shards_index(ag: ArtifactGraph) -> typing.Optional[bytes]:
+    """The shards index of the output of ``ag``, None if it has no repodata"""
+    if not ag.constrained_names:
+        return None
+    return _indexes.get(ag.output_key, lambda previous: build_index(ag))
+
+
+def get_shard(digest: str, graph: typing.Callable[[], ArtifactGraph]) -> typing.Optional[bytes]:
+    """The shard with sha256 ``digest``, sharding ``graph()`` again if it was evicted"""
+    shard = _shards.peek(digest)
+    if shard is None:
+        ag = graph()
+        if ag.constrained_names:
+            build_index(ag)
+            shard = _shards.peek(digest)
+    return shard
+
+
+def has_shard(digest: str) -> bool:
+    return digest in _shards
+
+
+def stats() -> dict:
+    return {"shards": _shards.stats(), "indexes": _indexes.stats()}
@@ -0,0 +1,139 @@
+import contextlib
+import hashlib
+import mmap
+import os
+import pathlib
+import time
+import typing
+from logging import getLogger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pandas.io import json
+
+from fetch import Validators
+from index import PackageIndex
+
+logger = getLogger(__name__)
+
+# Directory the server processes of a host share their indexes through, None disables it.
+# Every process maps the same files read-only, so the records of a channel are held once.
+SHARED_DIR: typing.Optional[pathlib.Path] = (
+    pathlib.Path(os.environ["METACHANNEL_SHARED_DIR"])
+    if os.environ.get("METACHANNEL_SHARED_DIR")
+    else None
+)
+
+# (url, counter) -> index mapped in this process
+_mapped: typing.Dict[typing.Tuple[str, int], PackageIndex] = {}
+
+
+class Published(typing.NamedTuple):
+    """The generation of a repodata index currently published in SHARED_DIR"""
+
+    url: str
+    # bumped on every publication, tells the files of successive generations apart
+    counter: int
+    # wall clock time of the last upstream check
+    checked: float
+    validators: Validators
+
+    @property
+    def path(self) -> pathlib.Path:
+        return _path(self.url).with_suffix(f".{self.counter}.index")
+
+
+def _path(url: str) -> pathlib.Path:
+    return SHARED_DIR / hashlib.sha256(url.encode("utf8")).hexdigest()[:32]
+
+
+@contextlib.contextmanager
+def lock(url: str):
+    """Hold the lock of ``url`` across processes, only its holder checks upstream"""
+    if fcntl is None:
+        # without flock every process polls on its own
+        yield
+        return
+    SHARED_DIR.mkdir(parents=True, exist_ok=True)
+    with _path(url).with_suffix(".lock").open("a") as fo:
+        fcntl.flock(fo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fo, fcntl.LOCK_UN)
+
+
+def published(url: str) -> typing.Optional[Published]:
+    try:
+        with _path(url).with_suffix(".json").open() as fo:
+            meta = json.loads(fo.read())
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != url:
+        return None
+    pub = Published(
+        url, meta["counter"], meta["checked"], Validators(*meta["validators"])
+    )
+    if not pub.path.exists():
+        return None
+    return pub
+
+
+def _write_meta(pub: Published):
+    path = _path(pub.url).with_suffix(".json")
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_text(
+        json.dumps(
+            {
+                "url": pub.url,
+                "counter": pub.counter,
+                "checked": pub.checked,
+                "validators": list(pub.validators),
+            }
+        )
+    )
+    # readers switch generations atomically
+    os.replace(tmp, path)
+
+
+def publish(url: str, index: PackageIndex, validators: Validators) -> Published:
+    """Write a new generation of the index of ``url``, to be called with its lock held"""
+    previous = published(url)
+    counter = previous.counter + 1 if previous is not None else 1
+    pub = Published(url, counter, time.time(), validators)
+    tmp = pub.path.with_suffix(".index.tmp")
+    with tmp.open("wb") as fo:
+        fo.write(index.to_bytes())
+    os.replace(tmp, pub.path)
+    _write_meta(pub)
+    if previous is not None and previous.counter != counter:
+        # processes that still map it keep their pages until they let go of them
+        with contextlib.suppress(OSError):
+            os.unlink(previous.path)
+    logger.info(f"PUBLISHED GENERATION {counter} OF {url}")
+    return pub
+
+
+def touch(pub: Published) -> Published:
+    """Record that upstream still serves the published generation"""
+    pub = pub._replace(checked=time.time())
+    _write_meta(pub)
+    return pub
+
+
+def load(pub: Published) -> PackageIndex:
+    """Map the published index read-only, once per process and generation"""
+    key = (pub.url, pub.counter)
+    index = _mapped.get(key)
+    if index is None:
+        with pub.path.open("rb") as fo:
+            buffer = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        index = PackageIndex.from_bytes(buffer)
+        # drop our older generations, the caches holding them release the mapping
+        for old in [k for k in _mapped if k[0] == pub.url]:
+            del _mapped[old]
+        _mapped[key] = index
+    return index
@@ -0,0 +1,69 @@
+"""Unit tests of admission control, and of the 503 answered to the requests it refuses"""
+
+import asyncio
+
+import pytest
+
+import admission
+from admission import Overloaded, WorkClass
+
+
+def test_slots_queue_up_to_max_queue():
+    async def main():
+        work_class = WorkClass("test", limit=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def hold(admit=True):
+            async with work_class.slot(admit):
+                await release.wait()
+
+        running = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        assert (work_class.running, work_class.waiting) == (1, 1)
+
+        with pytest.raises(Overloaded) as raised:
+            async with work_class.slot():
+                pass
+        assert raised.value.work_class is work_class
+        assert raised.value.retry_after >= 1
+
+        # background work waits its turn but is never refused
+        background = asyncio.ensure_future(hold(admit=False))
+        await asyncio.sleep(0)
+        assert work_class.waiting == 2
+
+        release.set()
+        await asyncio.gather(running, queued, background)
+        stats = work_class.stats()
+        assert (stats["running"], stats["queued"]) == (0, 0)
+        assert (stats["admitted"], stats["rejected"]) == (3, 1)
+
+    asyncio.run(main())
+
+
+def test_retry_after_grows_with_the_backlog():
+    work_class = WorkClass("test", limit=2, max_queue=8)
+    work_class.service_seconds = 3.0
+    assert work_class.retry_after() == 1
+    work_class.running, work_class.waiting = 2, 4
+    assert work_class.retry_after() == 9
+
+
+def test_overloaded_requests_get_503_with_retry_after(monkeypatch):
+    import app
+
+    monkeypatch.setattr(admission.BUILD, "max_queue", 0)
+    monkeypatch.setattr(admission.BUILD, "service_seconds", 2.0)
+
+    async def main():
+        client = app.app.test_client()
+        # redirects build the repodata of the channel when it is not cached
+        response = await client.get("/uncached-channel/python/linux-64/zlib-1.2.11-0.tar.bz2")
+        return response.status_code, response.headers.get("Retry-After")
+
+    status, retry_after = asyncio.run(main())
+    assert status == 503
+    assert int(retry_after) >= 1
+    assert admission.BUILD.rejected >= 1
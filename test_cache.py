@@ -0,0 +1,299 @@
+"""Unit tests of BuildCache"""
+
+import threading
+import types
+
+import pytest
+
+import cache
+from cache import BuildCache, CacheBudget
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock for the caches that only moves when told to"""
+    now = [1000.0]
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+
+    def advance(seconds):
+        now[0] += seconds
+
+    return advance
+
+
+def _cache(ttl=10, max_stale=60, budget=None, **kwargs):
+    return BuildCache(
+        "test",
+        ttl=ttl,
+        max_stale=max_stale,
+        sizeof=lambda value: 100,
+        budget=budget or CacheBudget(1 << 20),
+        **kwargs,
+    )
+
+
+def _wait_until(condition):
+    for _ in range(1000):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("timed out")
+
+
+def test_concurrent_misses_build_once():
+    c = _cache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def build(previous):
+        calls.append(1)
+        started.set()
+        release.wait(10)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(c.get("k", build))) for _ in range(5)]
+    threads[0].start()
+    started.wait(10)
+    for thread in threads[1:]:
+        thread.start()
+    # every follower is waiting on the build in flight before it finishes
+    _wait_until(lambda: c.stats()["coalesced"] == 4)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+    stats = c.stats()
+    assert (stats["misses"], stats["coalesced"], stats["inflight"]) == (1, 4, 0)
+    assert c.get("k", build) == "value"
+    assert c.stats()["hits"] == 1
+
+
+def test_failed_build_reaches_followers_and_is_retried():
+    c = _cache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail(previous):
+        started.set()
+        release.wait(10)
+        raise RuntimeError("upstream is down")
+
+    errors = []
+
+    def get():
+        try:
+            c.get("k", fail)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(3)]
+    threads[0].start()
+    started.wait(10)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_until(lambda: c.stats()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    # the leader and its followers all get the error, nothing is cached
+    assert len(errors) == 3
+    assert "k" not in c
+    assert c.stats()["inflight"] == 0
+    assert c.get("k", lambda previous: "value") == "value"
+
+
+def _wait_for_refresh(c, key):
+    future = c._inflight.get(key)
+    if future is not None:
+        future.exception(timeout=10)
+
+
+def test_stale_entries_are_served_while_refreshed(clock):
+    c = _cache(ttl=10, max_stale=60)
+    assert c.get("k", lambda previous: 1) == 1
+    clock(20)
+    release = threading.Event()
+    refreshes = []
+
+    def rebuild(previous):
+        release.wait(10)
+        refreshes.append(previous)
+        return 2
+
+    # the stale entry is answered at once, a single refresh built on it replaces it
+    assert c.get("k", rebuild) == 1
+    assert c.get("k", rebuild) == 1
+    release.set()
+    _wait_for_refresh(c, "k")
+    assert refreshes == [1]
+    assert c.get("k", rebuild) == 2
+    stats = c.stats()
+    assert (stats["stale_hits"], stats["refreshes"], stats["hits"]) == (2, 1, 1)
+
+
+def test_failed_refresh_keeps_the_stale_entry(clock):
+    c = _cache(ttl=10, max_stale=60)
+    c.get("k", lambda previous: "old")
+    clock(20)
+
+    def fail(previous):
+        raise RuntimeError("upstream is down")
+
+    assert c.get("k", fail) == "old"
+    _wait_for_refresh(c, "k")
+    assert "k" in c
+    assert c.get("k", fail) == "old"
+
+
+def test_entries_past_max_stale_are_rebuilt(clock):
+    c = _cache(ttl=10, max_stale=60)
+    c.get("k", lambda previous: "old")
+    clock(61)
+    assert "k" not in c
+    # the request blocks on the rebuild
+    assert c.get("k", lambda previous: "new") == "new"
+    assert c.stats()["stale_hits"] == 0
+
+
+def test_max_stale_below_ttl_disables_stale_entries(clock):
+    c = _cache(ttl=10, max_stale=0)
+    c.get("k", lambda previous: "old")
+    clock(11)
+    assert "k" not in c
+    assert c.get("k", lambda previous: "new") == "new"
+    assert c.stats()["stale_hits"] == 0
+
+
+def test_expire_drops_entries_past_max_stale(clock):
+    c = _cache(ttl=10, max_stale=60)
+    c.get("a", lambda previous: 1)
+    clock(30)
+    c.get("b", lambda previous: 2)
+    clock(40)
+    c.expire()
+    assert list(c.entries) == ["b"]
+    assert c.budget.used == 100
+
+
+def test_migrate():
+    c = _cache()
+    c.get("old", lambda previous: "value")
+    assert c.migrate("old", "new", str.upper)
+    assert c.entries["new"].value == "VALUE"
+    assert c.entries["old"].value == "value"
+    # existing entries and missing ones are left alone
+    assert not c.migrate("old", "new", str.lower)
+    assert not c.migrate("missing", "other")
+    assert c.entries["new"].value == "VALUE"
+    assert "other" not in c.entries
+
+
+def test_claim():
+    c = _cache()
+    leader, future = c.claim("k")
+    assert leader
+    follower, same = c.claim("k")
+    assert not follower and same is future
+    assert c.inflight("k") is future
+    c.fulfil("k", "value", 1.0, future)
+    assert same.result() == "value"
+    # a fresh entry is handed out right away
+    leader, future = c.claim("k")
+    assert not leader and future.result() == "value"
+    stats = c.stats()
+    assert (stats["misses"], stats["coalesced"], stats["hits"], stats["inflight"]) == (1, 1, 1, 0)
+
+    leader, future = c.claim("other")
+    c.abandon("other", future, RuntimeError("gone"))
+    with pytest.raises(RuntimeError):
+        future.result()
+    assert c.claim("other")[0]
+
+
+def _built_in(clock, seconds, value):
+    """A builder taking ``seconds`` of the fake clock to build ``value``"""
+
+    def build(previous):
+        clock(seconds)
+        return value
+
+    return build
+
+
+def test_eviction_keeps_what_is_hit_and_costly(clock):
+    budget = CacheBudget(350)
+    c = _cache(ttl=1e6, budget=budget)
+    c.get("cheap", _built_in(clock, 0.1, 1))
+    c.get("costly", _built_in(clock, 5.0, 2))
+    c.get("hit", _built_in(clock, 0.1, 3))
+    for _ in range(100):
+        c.get("hit", _built_in(clock, 0.1, 3))
+    c.get("new", _built_in(clock, 0.1, 4))
+
+    assert sorted(c.entries) == ["costly", "hit", "new"]
+    assert budget.used == 300
+    assert budget.stats()["evictions"] == 1
+    assert c.stats()["evictions"] == 1
+
+
+def test_budget_is_shared_between_caches(clock):
+    budget = CacheBudget(250)
+    first = _cache(ttl=1e6, budget=budget)
+    second = _cache(ttl=1e6, budget=budget)
+    first.get("a", _built_in(clock, 0.1, 1))
+    second.get("b", _built_in(clock, 1.0, 2))
+    second.get("c", _built_in(clock, 1.0, 3))
+    # the cheapest entry goes, whichever cache holds it
+    assert list(first.entries) == []
+    assert sorted(second.entries) == ["b", "c"]
+    assert budget.stats()["entries"] == 2
+
+
+def test_eviction_follows_dependents():
+    budget = CacheBudget(1 << 20)
+    parents = _cache(budget=budget)
+    children = _cache(budget=budget, depends_on=parents, dependencies=lambda value: value)
+    parents.put("p1", 1, cost=0.1)
+    parents.put("p2", 2, cost=10.0)
+    children.put("c1", ["p1", "p2"], cost=10.0)
+    children.put("c2", ["p2"], cost=10.0)
+
+    budget.max_bytes = 300
+    parents.put("p3", 3, cost=10.0)
+    # evicting p1 evicts c1 too, its memory is only freed along with it
+    assert sorted(parents.sizes()) == ["p2", "p3"]
+    assert sorted(children.sizes()) == ["c2"]
+    assert budget.used == 300
+    assert budget.stats()["evictions"] == 2
+
+
+def test_replaced_entries_stay_charged_while_depended_upon():
+    budget = CacheBudget(1 << 20)
+    parents = _cache(budget=budget)
+    children = _cache(budget=budget, depends_on=parents, dependencies=lambda value: value)
+    parents.put("p", 1, cost=1.0)
+    children.put("c1", ["p"], cost=1.0)
+    children.put("c2", ["p"], cost=1.0)
+
+    # c1 and c2 still hold the old value of p
+    parents.put("p", 2, cost=1.0)
+    assert budget.used == 400
+    assert parents.stats()["retired_bytes"] == 100
+    children.put("c1", ["p"], cost=1.0)
+    assert budget.used == 400
+    children.put("c2", ["p"], cost=1.0)
+    assert budget.used == 300
+    assert parents.stats()["retired_bytes"] == 0
+
+    # an old value sharing all its memory with the new one is not charged again
+    sharing = _cache(budget=budget, retained=lambda old, new: 0)
+    other = _cache(budget=budget, depends_on=sharing, dependencies=lambda value: value)
+    sharing.put("q", 1, cost=1.0)
+    other.put("d", ["q"], cost=1.0)
+    sharing.put("q", 2, cost=1.0)
+    assert budget.used == 500
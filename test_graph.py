@@ -0,0 +1,106 @@
+"""Unit tests of ArtifactGraph outputs, and of what they carry over from one generation to the next"""
+
+import json
+
+from conftest import record
+from graph import ArtifactGraph, ClosureMemo, get_closure_memo
+
+PACKAGES = {
+    "app-1.0-0.tar.bz2": record("app", "1.0", "0", depends=["lib"]),
+    "lib-1.0-0.tar.bz2": record("lib", "1.0", "0"),
+    "tool-1.0-0.tar.bz2": record("tool", "1.0", "0", depends=["lib"]),
+    "other-1.0-0.tar.bz2": record("other", "1.0", "0"),
+}
+
+
+def _generation(ag):
+    raws = (*ag.raw.raw_repodata, *ag.noarch.raw_repodata)
+    return tuple((raw.repodata_url, raw.generation) for raw in raws)
+
+
+def _serialized():
+    return ArtifactGraph._output_cache.stats()["misses"]
+
+
+def test_closure_memo_keeps_the_closures_a_change_does_not_touch(upstream):
+    upstream.publish("main", PACKAGES)
+    ag = upstream.graph(constraints=["app", "other"])
+    memo = get_closure_memo(_generation(ag))
+    assert memo.closures["app"] == {"app", "lib"}
+
+    upstream.publish("main", dict(PACKAGES, **{"other-2.0-0.tar.bz2": record("other", "2.0", "0")}))
+    refreshed = upstream.refresh(constraints=["app", "other"])
+    inherited = get_closure_memo(_generation(refreshed))
+    assert inherited is not memo
+    assert inherited.closures["app"] is memo.closures["app"]
+    # the closure of the package that changed was computed again
+    assert inherited.closures["other"] is not memo.closures["other"]
+    assert sorted(refreshed.constrained_names) == ["app", "lib", "other"]
+
+    # changing a dependency drops every closure that reaches it
+    assert ClosureMemo(memo, {"lib"}).closures == {"other": memo.closures["other"]}
+
+
+def test_outputs_are_carried_over_when_none_of_their_packages_changed(upstream):
+    upstream.publish("main", PACKAGES)
+    ag = upstream.graph(constraints=["app"])
+    body = ag.repodata_output().body
+
+    # refreshing serializes the output, unless it is carried over
+    serialized = _serialized()
+    upstream.publish("main", dict(PACKAGES, **{"other-2.0-0.tar.bz2": record("other", "2.0", "0")}))
+    refreshed = upstream.refresh(constraints=["app"])
+    assert refreshed.output_key != ag.output_key
+    assert _serialized() == serialized
+    output = refreshed.repodata_output()
+    assert output.body == body
+    assert output.etag == refreshed.etag != ag.etag
+
+    upstream.publish("main", dict(PACKAGES, **{"lib-2.0-0.tar.bz2": record("lib", "2.0", "0")}))
+    changed = upstream.refresh(constraints=["app"])
+    assert _serialized() == serialized + 1
+    assert b"lib-2.0-0.tar.bz2" in changed.repodata_output().body
+
+
+def test_untracked_features_are_rewritten_per_output(upstream):
+    upstream.publish(
+        "main",
+        {
+            "numpy-1.15-0.tar.bz2": record(
+                "numpy", "1.15", "0", depends=["python"], features="blas_openblas vc14"
+            ),
+            "python-3.7-0.tar.bz2": record("python", "3.7", "0"),
+            "other-1.0-0.tar.bz2": record("other", "1.0", "0"),
+        },
+    )
+    # a second output over the same index must not rewrite the shared record again
+    for constraints in (["numpy"], ["numpy", "other"]):
+        untracked = upstream.graph(constraints=[*constraints, "--untrack-features"])
+        numpy = json.loads(untracked.repodata_output().body)["packages"]["numpy-1.15-0.tar.bz2"]
+        assert numpy["depends"] == ["python", "blas * openblas", "vs2015_runtime"]
+        assert "features" not in numpy
+
+    plain = upstream.graph(constraints=["numpy"])
+    numpy = json.loads(plain.repodata_output().body)["packages"]["numpy-1.15-0.tar.bz2"]
+    assert numpy["depends"] == ["python"]
+    assert numpy["features"] == "blas_openblas vc14"
+
+
+def test_current_outputs_are_not_carried_over(upstream):
+    packages = {
+        "lib-1.0-0.tar.bz2": record("lib", "1.0", "0"),
+        "lib-2.0-0.tar.bz2": record("lib", "2.0", "0"),
+    }
+    upstream.publish("main", packages)
+    ag = upstream.graph(constraints=["lib", "--current"])
+    assert list(json.loads(ag.repodata_output().body)["packages"]) == ["lib-2.0-0.tar.bz2"]
+
+    # a package outside of the closure now needs the older lib, which becomes current too
+    packages["app-1.1-0.tar.bz2"] = record("app", "1.1", "0", depends=["lib <2"])
+    upstream.publish("main", packages)
+    refreshed = upstream.refresh(constraints=["lib", "--current"])
+    assert refreshed.constrained_names == ["lib"]
+    assert sorted(json.loads(refreshed.repodata_output().body)["packages"]) == [
+        "lib-1.0-0.tar.bz2",
+        "lib-2.0-0.tar.bz2",
+    ]
@@ -0,0 +1,185 @@
+"""Unit tests of PackageIndex, its serialization and the views layered over it"""
+
+import bz2
+import json
+
+import pytest
+
+from conftest import record
+from index import FEATURES, LayeredIndex, PackageIndex, changed_names, index_payload, latest_builds
+
+URL_PREFIX = "https://conda.anaconda.org/test/linux-64"
+
+PACKAGES = {
+    "python-3.6.0-0.tar.bz2": record("python", "3.6.0", "0", depends=["zlib", "openssl >=1.0"]),
+    "python-3.7.0-1.tar.bz2": record("python", "3.7.0", "1", 1, depends=["zlib"]),
+    "zlib-1.2.11-0.tar.bz2": record("zlib", "1.2.11", "0"),
+    "numpy-1.15-py36_0.tar.bz2": record("numpy", "1.15", "py36_0", depends=["python 3.6.*"]),
+    "numpy-1.15-py36_1.tar.bz2": record("numpy", "1.15", "py36_1", 1, depends=["python 3.6.*"]),
+    "numpy-1.15-py37_0.tar.bz2": record("numpy", "1.15", "py37_0", depends=["python 3.7.*"]),
+    "blas-1.0-mkl.tar.bz2": record("blas", "1.0", "mkl", track_features="blas_mkl"),
+    "ünicode-1.0-0.tar.bz2": record("ünicode", "1.0", "0", depends=["zlib"]),
+}
+
+
+def _index(packages=PACKAGES):
+    # from_packages adds the url to the records it is given
+    records = [(fn, dict(r)) for fn, r in packages.items()]
+    return PackageIndex.from_packages(records, "linux-64", URL_PREFIX)
+
+
+def test_records_are_grouped_by_name():
+    index = _index()
+    assert len(index) == len(PACKAGES)
+    for rid, filename in enumerate(index.filenames):
+        assert index.name_of(rid) == PACKAGES[filename]["name"]
+        assert index.record(rid) == dict(PACKAGES[filename], url=f"{URL_PREFIX}/{filename}")
+    numpy = [index.filenames[r] for r in index.records_of("numpy")]
+    assert sorted(numpy) == sorted(fn for fn in PACKAGES if fn.startswith("numpy-"))
+    assert [index.build_numbers[r] for r in index.records_of("python")] == [0, 1]
+
+
+def test_names_only_depended_upon():
+    index = _index()
+    # openssl has an id but no records
+    assert "openssl" in index
+    assert not index.has_records("openssl")
+    assert index.records_of("openssl") == range(0)
+    assert index.records_of("missing") == range(0)
+
+
+def test_dependency_names():
+    index = _index()
+    assert sorted(index.dependency_names("python")) == ["openssl", "zlib"]
+    assert index.dependency_names("numpy") == ["python"]
+    assert index.dependency_names("zlib") == []
+    rid = index.records_of("python")[1]
+    assert [index.names[d] for d in index.record_dependency_ids(rid)] == ["zlib"]
+
+
+def test_features_flag():
+    index = _index()
+    flagged = {index.filenames[r] for r in range(len(index)) if index.flags[r] & FEATURES}
+    assert flagged == {"blas-1.0-mkl.tar.bz2"}
+
+
+def test_layered_index_shadows_names():
+    base = _index()
+    overlay = _index({"zlib-1.3-0.tar.bz2": record("zlib", "1.3", "0", depends=["libgcc"])})
+    layered = LayeredIndex([base, overlay])
+    layer, rids = layered.records_of("zlib")
+    assert layer is overlay
+    assert [layer.filenames[r] for r in rids] == ["zlib-1.3-0.tar.bz2"]
+    assert layered.dependency_names("zlib") == ["libgcc"]
+    layer, rids = layered.records_of("python")
+    assert layer is base and len(rids) == 2
+    assert layered.records_of("missing") == (None, range(0))
+    assert layered.dependency_names("missing") == []
+    assert "libgcc" in layered and "missing" not in layered
+
+
+def _columns(index):
+    return {
+        name: list(getattr(index, name))
+        for name in (
+            "names",
+            "record_name",
+            "filenames",
+            "versions",
+            "builds",
+            "build_numbers",
+            "flags",
+            "record_deps_start",
+            "record_deps",
+            "name_records",
+            "name_deps_start",
+            "name_deps",
+            "fragment_offsets",
+            "fragment_lengths",
+        )
+    }
+
+
+def test_round_trip():
+    index = _index()
+    loaded = PackageIndex.from_bytes(index.to_bytes())
+
+    assert (loaded.arch, loaded.url_prefix) == ("linux-64", URL_PREFIX)
+    assert _columns(loaded) == _columns(index)
+    assert bytes(loaded.blob) == bytes(index.blob)
+    assert loaded.name_ids == index.name_ids
+    assert loaded.artifact_ids == index.artifact_ids
+    for rid, filename in enumerate(loaded.filenames):
+        assert loaded.record(rid) == dict(PACKAGES[filename], url=f"{URL_PREFIX}/{filename}")
+    for name in ("python", "numpy", "zlib", "openssl"):
+        assert loaded.records_of(name) == index.records_of(name)
+        assert loaded.dependency_names(name) == index.dependency_names(name)
+    assert loaded.latest_builds == index.latest_builds
+    assert loaded.current == index.current
+    # a loaded index serializes back to the same bytes
+    assert loaded.to_bytes() == index.to_bytes()
+
+
+def test_round_trip_of_an_empty_index():
+    loaded = PackageIndex.from_bytes(_index({}).to_bytes())
+    assert len(loaded) == 0
+    assert "python" not in loaded
+
+
+def test_from_bytes_shares_the_buffer():
+    buffer = _index().to_bytes()
+    loaded = PackageIndex.from_bytes(buffer)
+    blob = bytes(loaded.blob)
+    buffer[-len(blob) :] = bytes(len(blob))
+    # the arrays are views on the buffer rather than copies of it
+    assert bytes(loaded.blob) == bytes(len(blob))
+
+
+def test_from_bytes_rejects_other_data():
+    with pytest.raises(ValueError):
+        PackageIndex.from_bytes(b"not an index at all")
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_index_payload(compressed):
+    payload = json.dumps({"info": {"subdir": "linux-64"}, "packages": PACKAGES}).encode("utf8")
+    if compressed:
+        payload = bz2.compress(payload)
+    assert index_payload(payload, compressed, "linux-64", URL_PREFIX) == _index().to_bytes()
+
+
+def test_changed_names():
+    packages = dict(PACKAGES)
+    packages["zlib-1.2.11-0.tar.bz2"] = record("zlib", "1.2.11", "0", depends=["libgcc"])
+    del packages["blas-1.0-mkl.tar.bz2"]
+    packages["pip-18.0-py_0.tar.bz2"] = record("pip", "18.0", "py_0")
+    assert changed_names(_index(), _index(packages)) == {"zlib", "blas", "pip"}
+    assert changed_names(_index(), _index()) == frozenset()
+
+
+def test_latest_builds():
+    index = _index()
+    rids = index.records_of("numpy")
+    kept = [index.filenames[r] for r in latest_builds(index, rids)]
+    assert kept == ["numpy-1.15-py36_1.tar.bz2", "numpy-1.15-py37_0.tar.bz2"]
+
+
+def test_current():
+    packages = dict(PACKAGES)
+    packages["zlib-1.2.8-0.tar.bz2"] = record("zlib", "1.2.8", "0")
+    packages["openssl-1.0.2-0.tar.bz2"] = record("openssl", "1.0.2", "0")
+    packages["openssl-1.1.1-0.tar.bz2"] = record("openssl", "1.1.1", "0")
+    packages["numpy-1.14-py37_0.tar.bz2"] = record("numpy", "1.14", "py37_0", depends=["python 3.7.*"])
+    index = _index(packages)
+    kept = {index.filenames[r] for r in range(len(index)) if index.current[r]}
+    # the latest of every package, then python 3.6 that the py36 build of numpy needs
+    assert kept == {
+        "python-3.7.0-1.tar.bz2",
+        "python-3.6.0-0.tar.bz2",
+        "zlib-1.2.11-0.tar.bz2",
+        "openssl-1.1.1-0.tar.bz2",
+        "numpy-1.15-py36_1.tar.bz2",
+        "numpy-1.15-py37_0.tar.bz2",
+        "blas-1.0-mkl.tar.bz2",
+        "ünicode-1.0-0.tar.bz2",
+    }
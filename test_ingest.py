@@ -0,0 +1,76 @@
+"""Unit tests of the streaming repodata reader, wherever the chunks of a payload are cut"""
+
+import bz2
+import json
+
+import pytest
+
+from ingest import iter_packages
+
+REPODATA = {
+    "info": {"subdir": "linux-64", "n": 1.5e10, "values": [-1, 0.25, 1e-3, 10, True, None]},
+    "packages": {
+        "a-1.0-0.tar.bz2": {
+            "name": "a",
+            "version": "1.0",
+            "build_number": 12345,
+            "size": 1.5e10,
+            "depends": ["b >=1.0", "c"],
+            "license": "BSD \"3-clause\" \\ ünïcödé ✓",
+        },
+        "b-2.0-py_0.tar.bz2": {"name": "b", "version": "2.0", "timestamp": -1e-3, "depends": []},
+        "c-3-0.tar.bz2": {"name": "c", "version": "3", "nested": {"deep": [[], {}]}, "n": 0},
+    },
+    "packages.conda": {"d-1-0.conda": {"name": "d"}},
+    "removed": [],
+    "repodata_version": 1,
+}
+
+
+def _payload(indent=None):
+    return json.dumps(REPODATA, indent=indent, ensure_ascii=False).encode("utf8")
+
+
+def _chunks(payload, size):
+    return [payload[i : i + size] for i in range(0, len(payload), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_chunk_boundaries(size, indent):
+    packages = list(iter_packages(_chunks(_payload(indent), size), compressed=False))
+    assert packages == list(REPODATA["packages"].items())
+
+
+def test_every_cut_of_a_number():
+    # a number cut anywhere decodes whole, "1." and "1.5e" are not numbers yet
+    payload = b'{"info": {"n": 1.5e10}, "packages": {"a": {"size": -12.5E+3}}}'
+    for cut in range(1, len(payload)):
+        chunks = [payload[:cut], payload[cut:]]
+        assert list(iter_packages(chunks, compressed=False)) == [("a", {"size": -12500.0})]
+
+
+@pytest.mark.parametrize("size", [1, 5, 4096])
+def test_compressed(size):
+    payload = bz2.compress(_payload())
+    packages = list(iter_packages(_chunks(payload, size), compressed=True))
+    assert packages == list(REPODATA["packages"].items())
+
+
+def test_number_at_the_end_of_the_payload():
+    payload = b'{"packages": {}, "repodata_version": 1}'
+    assert list(iter_packages(_chunks(payload, 1), compressed=False)) == []
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        b'{"packages": {"a": {"name": "a"}}',
+        b'{"packages": {"a": {"name": "a"}}} trailing',
+        b'["packages"]',
+        b'{"packages": {"a": {"name": "a"},}}',
+    ],
+)
+def test_invalid_payloads(payload):
+    with pytest.raises(ValueError):
+        list(iter_packages(_chunks(payload, 3), compressed=False))
@@ -0,0 +1,122 @@
+"""Unit tests of the repodata.jlap patch feeds"""
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from conftest import record
+from jlap import PatchFeed
+
+
+def _blake2(data, key=b""):
+    return hashlib.blake2b(data, digest_size=32, key=key).digest()
+
+
+def _verify(feed_bytes):
+    """Check the chain of a rendered feed the way clients do, returns its patches and footer"""
+    lines = feed_bytes.split(b"\n")
+    assert lines[-1] == b""
+    iv, *body, footer, trailer = lines[:-1]
+    checksum = bytes.fromhex(iv.decode("ascii"))
+    for line in (*body, footer):
+        checksum = _blake2(line, checksum)
+    assert checksum.hex() == trailer.decode("ascii")
+    return [json.loads(line) for line in body], json.loads(footer)
+
+
+GENERATIONS = [
+    {"a-1-0.tar.bz2": record("a", "1", "0")},
+    {"a-1-0.tar.bz2": record("a", "1", "0"), "b-1-0.tar.bz2": record("b", "1", "0")},
+    {"b-1-0.tar.bz2": record("b", "1", "0", depends=["c"])},
+    {"b-1-0.tar.bz2": record("b", "1", "0"), "a~/x-2-0.tar.bz2": record("a", "2", "0")},
+]
+
+
+def _graphs(upstream):
+    """The graph of every generation of a channel, in order"""
+    graphs = []
+    for packages in GENERATIONS:
+        upstream.publish("main", packages)
+        graphs.append(upstream.refresh())
+    return graphs
+
+
+def test_empty_feed():
+    patches, footer = _verify(PatchFeed().render("repodata.json"))
+    assert patches == []
+    assert footer == {"url": "repodata.json", "latest": None}
+
+
+def test_checksum_chain(upstream):
+    feed = PatchFeed()
+    graphs = _graphs(upstream)
+    for ag in graphs:
+        assert feed.update(ag)
+    # the same generation is only recorded once
+    assert not feed.update(graphs[-1])
+
+    patches, footer = _verify(feed.render())
+    hashes = [_blake2(ag.repodata_output().body).hex() for ag in graphs]
+    assert [(p["from"], p["to"]) for p in patches] == list(zip(hashes, hashes[1:]))
+    assert footer == {"url": "repodata.json", "latest": hashes[-1]}
+    added = dict(GENERATIONS[1]["b-1-0.tar.bz2"], url=f"{upstream.url_prefix('main')}/b-1-0.tar.bz2")
+    assert patches[0]["patch"] == [
+        {"op": "add", "path": "/packages/b-1-0.tar.bz2", "value": added}
+    ]
+    assert sorted(op["op"] for op in patches[1]["patch"]) == ["add", "remove"]
+    # filenames are escaped as JSON pointers
+    assert {op["path"] for op in patches[2]["patch"]} == {
+        "/packages/b-1-0.tar.bz2",
+        "/packages/a~0~1x-2-0.tar.bz2",
+    }
+
+
+def test_checksum_chain_once_trimmed(upstream):
+    feed = PatchFeed(max_patches=2)
+    graphs = _graphs(upstream)
+    for ag in graphs:
+        feed.update(ag)
+
+    patches, footer = _verify(feed.render())
+    # the first patch is dropped, the chain starts from the checksum that preceded the rest
+    hashes = [_blake2(ag.repodata_output().body).hex() for ag in graphs]
+    assert [(p["from"], p["to"]) for p in patches] == list(zip(hashes[1:], hashes[2:]))
+    assert feed.render().split(b"\n")[0] != bytes(32).hex().encode("ascii")
+    assert footer["latest"] == hashes[-1]
+
+
+_BODY_HASH = """
+import hashlib
+
+import fetch
+from conftest import Upstream, record
+
+upstream = Upstream()
+fetch.SESSION = upstream
+upstream.publish("main", {
+    f"{name}-1-0.tar.bz2": record(name, "1", "0", depends=[f"dep{i}" for i in range(8)])
+    for name in ("a", "b", "c")
+})
+upstream.publish("main", {
+    f"dep{i}-1-0.tar.bz2": record(f"dep{i}", "1", "0") for i in range(8)
+}, arch="noarch")
+ag = upstream.graph(constraints=["a", "b"])
+print(hashlib.sha256(ag.repodata_output().body).hexdigest())
+"""
+
+
+def test_bodies_do_not_depend_on_the_process():
+    # workers serve the same ETag and feed hashes, so they have to write the same body
+    outputs = {
+        subprocess.run(
+            [sys.executable, "-c", _BODY_HASH],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, PYTHONHASHSEED=str(seed)),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.split()[-1]
+        for seed in range(4)
+    }
+    assert len(outputs) == 1
@@ -0,0 +1,172 @@
+"""Unit tests of the conda version ordering and matching, and of the record pruning built on it"""
+
+import pytest
+
+from conftest import record
+from graph import ArtifactGraph, parse_constraints
+from versions import MatchSpec, VersionOrder, VersionSpec
+
+
+@pytest.mark.parametrize(
+    "versions",
+    [
+        # the ordering documented by conda
+        [
+            "0.4",
+            "0.4.1.rc",
+            "0.4.1",
+            "0.5a1",
+            "0.5b3",
+            "0.5C1",
+            "0.5",
+            "0.9.6",
+            "0.960923",
+            "1.0",
+            "1.1dev1",
+            "1.1_",
+            "1.1a1",
+            "1.1.0dev1",
+            "1.1.a1",
+            "1.1.0rc1",
+            "1.1.0",
+            "1.1.0post1",
+            "1.1post1",
+            "1996.07.12",
+            "1!0.4.1",
+            "1!3.1.1.6",
+            "2!0.4.1",
+        ],
+        ["1.0.1dev", "1.0.1_", "1.0.1a", "1.0.1"],
+        ["1.0.1", "1.0.1+1", "1.0.1+2", "1.0.2"],
+    ],
+)
+def test_version_order(versions):
+    orders = [VersionOrder(v) for v in versions]
+    for lower, higher in zip(orders, orders[1:]):
+        assert lower < higher, (lower, higher)
+    assert sorted(reversed(orders)) == orders
+
+
+@pytest.mark.parametrize(
+    "v1, v2",
+    [
+        ("0.4", "0.4.0"),
+        ("0.4.1.rc", "0.4.1.RC"),
+        ("1.1.0dev1", "1.1.dev1"),
+        ("1.1.0", "1.1"),
+        ("1.1.0post1", "1.1.post1"),
+        ("0!1.0", "1.0"),
+    ],
+)
+def test_version_equal(v1, v2):
+    assert VersionOrder(v1) == VersionOrder(v2)
+
+
+@pytest.mark.parametrize(
+    "spec, version, expected",
+    [
+        ("1.*", "1.5", True),
+        ("1.*", "10.0", False),
+        ("3.1.*", "3.1a1", True),
+        ("3.1.*", "3.10", False),
+        ("*", "3", True),
+        ("!=1.*", "1.2", False),
+        ("!=1.*", "2.0", True),
+        ("=3.6", "3.6.5", True),
+        ("=3.6", "3.7", False),
+        ("3.6", "3.6.0", True),
+        ("3.6", "3.6.5", False),
+        ("~=2.3", "2.3", True),
+        ("~=2.3", "2.5", True),
+        ("~=2.3", "2.2", False),
+        ("~=2.3", "3.0", False),
+        (">=1,<2", "1.5", True),
+        (">=1,<2", "2.0", False),
+        # "," binds tighter than "|"
+        ("1.0|2.0,<2", "1.0", True),
+        ("1.0|2.0,<2", "2.0", False),
+        (">=1,<2|>=3", "3.1", True),
+        (">=1,<2|>=3", "2.5", False),
+    ],
+)
+def test_version_spec(spec, version, expected):
+    assert VersionSpec(spec).match(version) is expected
+
+
+def test_match_spec():
+    spec = MatchSpec.parse("python 3.6.* *_cpython")
+    assert spec.name == "python"
+    assert spec.match("3.6.5", "h1_cpython")
+    assert not spec.match("3.6.5", "h1_pypy")
+    assert not spec.match("3.7.0", "h1_cpython")
+    # a bare star does not constrain anything
+    assert MatchSpec.parse("numpy *").version is None
+    assert MatchSpec.parse("numpy").match("1.0", "py36_0")
+    with pytest.raises(ValueError):
+        MatchSpec.parse("!numpy")
+
+
+def _package(name, version, build, depends=()):
+    return f"{name}-{version}-{build}.tar.bz2", record(name, version, build, depends=depends)
+
+
+PACKAGES = dict(
+    [
+        _package("python", "3.6.0", "0"),
+        _package("python", "3.7.0", "0"),
+        _package("pip", "10.0", "py_0", ["python"]),
+        _package("mkl", "2018", "0"),
+        _package("numpy", "1.14", "py36_0", ["python >=3.6,<3.7"]),
+        _package("numpy", "1.15", "py36_0", ["python >=3.6,<3.7", "mkl"]),
+        _package("numpy", "1.15", "py37_0", ["python >=3.7,<3.8"]),
+        _package("pandas", "0.22", "0", ["numpy >=1.14", "python"]),
+    ]
+)
+
+
+def _graph(upstream, *constraints):
+    """The graph of pandas over PACKAGES, under ``constraints``"""
+    upstream.publish("main", PACKAGES)
+    return upstream.graph(constraints=["pandas", *constraints])
+
+
+def _kept(ag, name):
+    return sorted(filename for filename, _ in ag.records_of(name))
+
+
+def test_pruned_closure_unconstrained(upstream):
+    ag = _graph(upstream)
+    assert set(ag.constrained_names) == {"pandas", "numpy", "python", "pip", "mkl"}
+    assert len(_kept(ag, "numpy")) == 3
+
+
+def test_pruned_closure_pin(upstream):
+    ag = _graph(upstream, "--pin=python 3.7.*")
+    # only numpy built for python 3.7 is kept, it does not pull mkl in
+    assert set(ag.constrained_names) == {"pandas", "numpy", "python", "pip"}
+    assert _kept(ag, "numpy") == ["numpy-1.15-py37_0.tar.bz2"]
+    assert _kept(ag, "python") == ["python-3.7.0-0.tar.bz2"]
+
+    ag = _graph(upstream, "--pin=python 3.6.*")
+    assert set(ag.constrained_names) == {"pandas", "numpy", "python", "pip", "mkl"}
+    assert _kept(ag, "numpy") == ["numpy-1.14-py36_0.tar.bz2", "numpy-1.15-py36_0.tar.bz2"]
+
+
+def test_pruned_closure_latest_n(upstream):
+    ag = _graph(upstream, "--latest-n=1")
+    assert set(ag.constrained_names) == {"pandas", "numpy", "python", "pip", "mkl"}
+    assert _kept(ag, "numpy") == ["numpy-1.15-py36_0.tar.bz2", "numpy-1.15-py37_0.tar.bz2"]
+    assert _kept(ag, "python") == ["python-3.7.0-0.tar.bz2"]
+
+
+def test_pruned_closure_pin_and_latest_n(upstream):
+    ag = _graph(upstream, "--pin=python 3.6.*", "--latest-n=1")
+    # the latest versions are picked among the records that satisfy the pins
+    assert _kept(ag, "numpy") == ["numpy-1.15-py36_0.tar.bz2"]
+    assert _kept(ag, "python") == ["python-3.6.0-0.tar.bz2"]
+    assert set(ag.constrained_names) == {"pandas", "numpy", "python", "pip", "mkl"}
+
+
+def test_invalid_record_constraints_are_ignored():
+    _, functional_constraints = parse_constraints(["--pin=!python", "--latest-n=0", "--latest-n=x"])
+    assert ArtifactGraph.parse_record_constraints(functional_constraints) == ({}, None)
@@ -0,0 +1,180 @@
+import fnmatch
+import functools
+import re
+import typing
+from itertools import zip_longest
+
+_COMPONENT = re.compile(r"([0-9]+|[^0-9]+)")
+_OPERATOR = re.compile(r"^(==|!=|>=|<=|~=|>|<|=)?\s*(.+)$")
+_NAME = re.compile(r"^([A-Za-z0-9_.\-]+)\s*(.*)$")
+
+
+@functools.total_ordering
+class VersionOrder:
+    """Orders version strings the way conda does.
+
+    The version is split into components on ``.``, ``_`` and ``-``, and each
+    component into its numeric and alphabetic parts.  Numbers compare numerically
+    and come after strings, ``dev`` comes before any other string and ``post`` after
+    everything, missing parts count as 0.  An epoch (``1!``) overrides everything
+    else and a local version (``+local``) breaks ties.
+
+    """
+
+    __slots__ = ("version", "epoch", "main", "local")
+
+    def __init__(self, version: str):
+        self.version = version
+        v = version.strip().lower()
+        epoch, _, v = v.rpartition("!")
+        self.epoch = int(epoch) if epoch else 0
+        v, _, local = v.partition("+")
+        self.main = self._split(v)
+        self.local = self._split(local) if local else ()
+
+    @staticmethod
+    def _split(v: str) -> tuple:
+        # a trailing underscore belongs to the last component, as in openssl's 1.0.1_
+        trailing = v.endswith("_")
+        if trailing:
+            v = v[:-1]
+        components = []
+        for component in re.split(r"[._\-]", v):
+            parts = [] if component[:1].isdigit() else [0]
+            for part in _COMPONENT.findall(component):
+                if part.isdigit():
+                    parts.append(int(part))
+                elif part == "post":
+                    parts.append(float("inf"))
+                elif part == "dev":
+                    # upper case sorts before every other string
+                    parts.append("DEV")
+                else:
+                    parts.append(part)
+            components.append(tuple(parts))
+        if trailing:
+            components[-1] += ("_",)
+        return tuple(components)
+
+    @staticmethod
+    def _compare(v1: tuple, v2: tuple) -> int:
+        for c1, c2 in zip_longest(v1, v2, fillvalue=()):
+            for p1, p2 in zip_longest(c1, c2, fillvalue=0):
+                if p1 == p2:
+                    continue
+                if isinstance(p1, str) != isinstance(p2, str):
+                    # strings come before numbers
+                    return -1 if isinstance(p1, str) else 1
+                return -1 if p1 < p2 else 1
+        return 0
+
+    def _key_compare(self, other: "VersionOrder") -> int:
+        if self.epoch != other.epoch:
+            return -1 if self.epoch < other.epoch else 1
+        return self._compare(self.main, other.main) or self._compare(self.local, other.local)
+
+    def __eq__(self, other):
+        return self._key_compare(other) == 0
+
+    def __lt__(self, other):
+        return self._key_compare(other) < 0
+
+    def __hash__(self):
+        return hash(self.version)
+
+    def __repr__(self):
+        return f"VersionOrder({self.version!r})"
+
+    def startswith(self, prefix: "VersionOrder") -> bool:
+        if self.epoch != prefix.epoch or len(self.main) < len(prefix.main):
+            return False
+        *head, last = prefix.main
+        if list(self.main[: len(head)]) != head:
+            return False
+        # the last component may go on, 3.1 starts 3.1a but not 3.10
+        component = self.main[len(head)]
+        return component[: len(last)] == last and (
+            len(component) == len(last) or isinstance(component[len(last)], str)
+        )
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def version_order(version: str) -> VersionOrder:
+    return VersionOrder(version)
+
+
+def _match_one(spec: str, version: VersionOrder) -> bool:
+    operator, value = _OPERATOR.match(spec.strip()).groups()
+    glob = value.endswith("*")
+    if glob:
+        value = value.rstrip("*").rstrip(".")
+        if not value:
+            return operator != "!="
+    if operator == "=" and not glob:
+        # =3.11 means 3.11.*
+        operator, glob = None, True
+    target = version_order(value)
+    if glob:
+        matched = version.startswith(target)
+        return not matched if operator == "!=" else matched
+    if operator in (None, "=="):
+        return version == target
+    if operator == "!=":
+        return version != target
+    if operator == ">=":
+        return version >= target
+    if operator == "<=":
+        return version <= target
+    if operator == ">":
+        return version > target
+    if operator == "<":
+        return version < target
+    # ~=2.3 is >=2.3 and 2.*
+    return version >= target and version.startswith(version_order(value.rpartition(".")[0]))
+
+
+class VersionSpec:
+    """A conda version specification, ``|`` is or, ``,`` is and and binds tighter"""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        self._alternatives = [
+            [part for part in alternative.split(",") if part.strip()]
+            for alternative in spec.split("|")
+        ]
+
+    def match(self, version: str) -> bool:
+        v = version_order(version)
+        return any(
+            all(_match_one(part, v) for part in alternative)
+            for alternative in self._alternatives
+        )
+
+    def __repr__(self):
+        return f"VersionSpec({self.spec!r})"
+
+
+class MatchSpec(typing.NamedTuple):
+    """``name [version [build]]``, as found in ``depends``, or ``name=version``, ``name>=version``"""
+
+    name: str
+    version: typing.Optional[VersionSpec] = None
+    build: typing.Optional[str] = None
+
+    @classmethod
+    def parse(cls, spec: str) -> "MatchSpec":
+        match = _NAME.match(spec.strip())
+        if match is None:
+            raise ValueError(f"invalid match spec {spec!r}")
+        name, rest = match.groups()
+        version, _, build = rest.strip().partition(" ")
+        return cls(
+            name,
+            VersionSpec(version) if version and version != "*" else None,
+            build.strip() or None,
+        )
+
+    def match(self, version: str, build: str) -> bool:
+        if self.version is not None and not self.version.match(version):
+            return False
+        return self.build is None or fnmatch.fnmatchcase(build, self.build)
@@ -0,0 +1,80 @@
+import threading
+import time
+import typing
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class _Heat:
+    __slots__ = ("hits", "last_seen", "encodings")
+
+    def __init__(self):
+        self.hits = 0.0
+        self.last_seen = 0.0
+        self.encodings = set()
+
+
+class HotKeys:
+    """Tracks which metachannels live traffic asks for, to warm only those.
+
+    Hit counts decay by half every ``half_life`` seconds, and keys that have not been
+    asked for in ``idle`` seconds are forgotten.
+
+    """
+
+    def __init__(self, max_keys: int = 64, idle: float = 3600, half_life: float = 600):
+        self.max_keys = max_keys
+        self.idle = idle
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._keys: typing.Dict[tuple, _Heat] = {}
+
+    def _decayed(self, heat: _Heat, now: float) -> float:
+        return heat.hits * 0.5 ** ((now - heat.last_seen) / self.half_life)
+
+    def record(self, key: tuple, encoding: str):
+        now = time.monotonic()
+        with self._lock:
+            heat = self._keys.get(key)
+            if heat is None:
+                heat = self._keys[key] = _Heat()
+            heat.hits = self._decayed(heat, now) + 1
+            heat.last_seen = now
+            heat.encodings.add(encoding)
+            if len(self._keys) > 4 * self.max_keys:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        # called with the lock held
+        ranked = sorted(
+            (k for k, heat in self._keys.items() if now - heat.last_seen < self.idle),
+            key=lambda k: self._decayed(self._keys[k], now),
+            reverse=True,
+        )
+        self._keys = {k: self._keys[k] for k in ranked[: self.max_keys]}
+
+    def hottest(self) -> typing.List[typing.Tuple[tuple, typing.FrozenSet[str]]]:
+        """The ``max_keys`` keys asked for the most lately, with the encodings asked for"""
+        with self._lock:
+            self._prune(time.monotonic())
+            return [(k, frozenset(heat.encodings)) for k, heat in self._keys.items()]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "tracked": len(self._keys),
+                "hottest": [
+                    [list(k), round(self._decayed(heat, now), 2)]
+                    for k, heat in sorted(
+                        self._keys.items(),
+                        key=lambda item: self._decayed(item[1], now),
+                        reverse=True,
+                    )[:10]
+                ],
+            }
+
+
+# (channel, constraints, arch, repodata_file) of the repodata requests served
+HOT_KEYS = HotKeys()